@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the region data pipeline and the web app.
+
+Times the ensemble calculations, the region aggregation and the web routes on synthetic NetCDF grids
+at several resolutions, over the real shapefiles and synthetic region sets of several sizes. The
+Redis loader is timed too if a Redis server is reachable. Results are saved as JSON named after the
+current commit, so a run can be compared against the results of another commit:
+
+    python benchmark.py
+    python benchmark.py --compare benchmarks/<other commit>.json
+"""
+import numpy
+import xarray
+import geopandas
+import shapely
+import argparse
+import importlib
+import statistics
+import subprocess
+import platform
+import tempfile
+import json
+import time
+import sys
+import os
+import persad_data_analyze as pdata
+import generate_region_data as gdata
+import region_results as rresults
+
+output_dir = "benchmarks/"
+shapefile_dir = "shapefiles/"
+# Grid spacing (degrees) of the synthetic NetCDF grids
+resolutions = [0.5, 0.25, 0.125]
+# Sizes of the synthetic region sets, in addition to every shapefile in shapefile_dir
+region_counts = [100, 1000]
+# Number of models in the synthetic ensembles
+model_count = 10
+# Number of fields aggregated at once in the stacked benchmark (8 metrics x 2 RCPs x 2 products in the real pipeline)
+stacked_field_count = 32
+# Extra region statistics timed along with the stacked mean
+benchmark_statistics = ["std", "min", "max", "iqr", "ge8"]
+repeat = 3
+
+redis_host = "127.0.0.1"
+redis_port = 6379
+# The Redis loader is benchmarked in its own database so the dataset being served is never replaced
+redis_db = 15
+
+def getCommit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def timeFunction(function, repeat:int) -> dict:
+    """
+    Parameters
+    ----------
+    function : callable
+        function to time, called without arguments
+    repeat : int
+        number of times to call it
+
+    Returns
+    -------
+    dict
+        'times' of every call in seconds, and the 'best' and 'median' of them
+    """
+    times = []
+    for index in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'times':times, 'best':min(times), 'median':statistics.median(times)}
+
+def addResult(results:list, name:str, params:dict, timing:dict) -> None:
+    results.append({'name':name, 'params':params, **timing})
+    print("{:<32} {:<60} best {:9.4f} s   median {:9.4f} s".format(name, json.dumps(params), timing['best'], timing['median']))
+
+def makeSyntheticModels(resolution:float, count:int, seed:int=0) -> list:
+    """
+    Parameters
+    ----------
+    resolution : float
+        grid spacing in degrees
+    count : int
+        number of models
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    list of xarray.DataArray
+        (lat, lon) models over CALIFORNIA_BOUNDS, positive with a few NaN cells (like the ocean in the real data)
+    """
+    lat_min, lat_max, lon_min, lon_max = pdata.CALIFORNIA_BOUNDS
+    lat = numpy.arange(lat_min + resolution / 2, lat_max, resolution)
+    lon = numpy.arange(lon_min + resolution / 2, lon_max, resolution)
+    rng = numpy.random.default_rng(seed)
+    models = []
+    for index in range(count):
+        values = rng.gamma(2.0, 50.0, size=(len(lat), len(lon)))
+        values[rng.random(values.shape) < 0.1] = numpy.nan
+        models.append(xarray.DataArray(values, coords={'lat':lat, 'lon':lon}, dims=('lat', 'lon'), name="model_" + str(index)))
+    return models
+
+def writeSyntheticRegions(path:str, count:int) -> None:
+    # A square grid of box regions over California, named "region_<index>"
+    lat_min, lat_max, lon_min, lon_max = pdata.CALIFORNIA_BOUNDS
+    side = int(numpy.ceil(numpy.sqrt(count)))
+    lon_edges = numpy.linspace(lon_min, lon_max, side + 1)
+    lat_edges = numpy.linspace(lat_min, lat_max, side + 1)
+    boxes = [shapely.box(lon_edges[index % side], lat_edges[index // side], lon_edges[index % side + 1], lat_edges[index // side + 1]) for index in range(count)]
+    geopandas.GeoDataFrame({'NAME':["region_" + str(index) for index in range(count)]}, geometry=boxes, crs="epsg:4326").to_file(path)
+
+def getRegionSets(work_dir:str, counts:list) -> list:
+    # (name, shapefile path, name variable, number of regions) of every shapefile available and every synthetic region set
+    region_sets = []
+    for shapefile, s_var_name in zip(gdata.shapefiles, gdata.var_name):
+        path = shapefile_dir + shapefile + ".shp"
+        if os.path.isfile(path):
+            region_sets.append((shapefile, path, s_var_name, len(geopandas.read_file(path, ignore_geometry=True))))
+    for count in counts:
+        path = os.path.join(work_dir, "synthetic_" + str(count) + ".shp")
+        writeSyntheticRegions(path, count)
+        region_sets.append(("synthetic_" + str(count), path, "NAME", count))
+    return region_sets
+
+def benchmarkEnsemble(results:list, work_dir:str, resolution:float, models:list, historical_models:list, repeat:int) -> None:
+    params = {'resolution':resolution, 'cells':models[0].size, 'models':len(models)}
+    # The models are saved to (and loaded from) one NetCDF file, like the real data
+    path = os.path.join(work_dir, "synthetic_{}.nc".format(resolution))
+    xarray.Dataset({model.name:model for model in models}).to_netcdf(path)
+    names = [model.name for model in models]
+    addResult(results, "getModelsFromNetCDF", params, timeFunction(lambda: pdata.getModelsFromNetCDF(path, names, exact=True, bounds=pdata.CALIFORNIA_BOUNDS), repeat))
+    addResult(results, "getRelativeRatioModels", params, timeFunction(lambda: pdata.getRelativeRatioModels(models, historical_models), repeat))
+    mean_model = pdata.getMeanModel(models)
+    addResult(results, "getMeanModel", params, timeFunction(lambda: pdata.getMeanModel(models), repeat))
+    addResult(results, "getModelsAgreement", params, timeFunction(lambda: pdata.getModelsAgreement(mean_model, models), repeat))
+    addResult(results, "getEnsembleStatistics", params, timeFunction(lambda: pdata.getEnsembleStatistics(models), repeat))
+    addResult(results, "getRelativeRatioEnsemble (float32, from file)", params,
+              timeFunction(lambda: pdata.getRelativeRatioEnsemble(pdata.iterModelsFromNetCDF(path, names, exact=True, bounds=pdata.CALIFORNIA_BOUNDS, dtype=numpy.float32),
+                                                                  historical_models, dtype=numpy.float32), repeat))
+
+def benchmarkRegions(results:list, work_dir:str, resolution:float, data:xarray.DataArray, region_set:tuple, repeat:int, legacy:bool) -> None:
+    name, path, s_var_name, count = region_set
+    params = {'resolution':resolution, 'cells':data.size, 'region_set':name, 'regions':count}
+    cache_dir = os.path.join(work_dir, "weight_cache")
+    # Without a cache the weights are recalculated every time, with a warm cache they are only loaded
+    addResult(results, "analyzeRegions (no cache)", params, timeFunction(lambda: gdata.analyzeRegions(path, s_var_name, data), repeat))
+    addResult(results, "analyzeRegions (raster, no cache)", {**params, 'supersample':gdata.raster_supersample},
+              timeFunction(lambda: gdata.analyzeRegions(path, s_var_name, data, weight_mode="raster", supersample=gdata.raster_supersample), repeat))
+    gdata.analyzeRegions(path, s_var_name, data, cache_dir=cache_dir)
+    addResult(results, "analyzeRegions (cached)", params, timeFunction(lambda: gdata.analyzeRegions(path, s_var_name, data, cache_dir=cache_dir), repeat))
+    stacked = xarray.concat([data] * stacked_field_count, dim='field').assign_coords(field=numpy.arange(stacked_field_count))
+    addResult(results, "analyzeRegionsStacked (cached)", {**params, 'fields':stacked_field_count},
+              timeFunction(lambda: gdata.analyzeRegionsStacked(path, s_var_name, stacked, cache_dir=cache_dir), repeat))
+    addResult(results, "analyzeRegionsStacked (cached, statistics)", {**params, 'fields':stacked_field_count, 'statistics':",".join(benchmark_statistics)},
+              timeFunction(lambda: gdata.analyzeRegionsStacked(path, s_var_name, stacked, cache_dir=cache_dir, statistics=benchmark_statistics), repeat))
+    if legacy:
+        # The original per-cell loop takes minutes even on small inputs, so it is only timed once
+        addResult(results, "analyzeRegions (per cell)", params, timeFunction(lambda: gdata.analyzeRegions(path, s_var_name, data, weight_mode="cell"), 1))
+
+def makeSyntheticResults(work_dir:str, region_set:str, count:int, seed:int=0) -> str:
+    # A results file with every metric, RCP and product the pipeline writes, for count regions
+    fields = [(metric, rcp.strip("_"), product) for metric in gdata.metrics for rcp in gdata.rcps for product in gdata.products]
+    rng = numpy.random.default_rng(seed)
+    path = os.path.join(work_dir, region_set + gdata.results_suffix)
+    rresults.saveRegionResults(path, ["region_" + str(index) for index in range(count)], numpy.ones(count, dtype=bool),
+                               ["{}_{}_{}".format(*field) for field in fields], rng.normal(size=(count, len(fields))),
+                               [field[0] for field in fields], [field[1] for field in fields], [field[2] for field in fields])
+    return path
+
+def benchmarkWeb(results:list, work_dir:str, counts:list, repeat:int) -> None:
+    # The web app is benchmarked on the embedded results backend, so no Redis server is needed
+    os.environ["WEBAPP_DATA_BACKEND"] = "results"
+    import webapp
+    import data_backends as dbackends
+    client = webapp.app.test_client()
+    for count in counts:
+        region_set = "synthetic_" + str(count)
+        makeSyntheticResults(work_dir, region_set, count)
+        webapp.data_backend = dbackends.ResultsBackend(work_dir, [region_set], gdata.results_suffix)
+        webapp.data_cache.setVersion(webapp.data_backend.getVersion())
+        url = "/data/et_RCP85_{}_totalaverage".format(region_set)
+        params = {'region_set':region_set, 'regions':count}
+        def getUncached():
+            webapp.data_cache.entries.clear()
+            client.get(url, headers={'Accept-Encoding':'gzip'})
+        # Each request is fast, so every timing is of 100 requests
+        addResult(results, "/data (x100, uncached)", params, timeFunction(lambda: [getUncached() for index in range(100)], repeat))
+        addResult(results, "/data (x100, cached)", params, timeFunction(lambda: [client.get(url, headers={'Accept-Encoding':'gzip'}) for index in range(100)], repeat))
+        etag = client.get(url).headers['ETag']
+        addResult(results, "/data (x100, not modified)", params, timeFunction(lambda: [client.get(url, headers={'If-None-Match':etag}) for index in range(100)], repeat))
+        region_url = "/data/{}/region_0?fields=et_RCP85_totalaverage,et_RCP45_totalaverage".format(region_set)
+        addResult(results, "/data region (x100, uncached)", params,
+                  timeFunction(lambda: [webapp.data_cache.entries.clear() or client.get(region_url) for index in range(100)], repeat))
+    for shapefile in gdata.shapefiles:
+        path = shapefile_dir + shapefile + ".dbf"
+        if os.path.isfile(os.path.join(webapp.app.root_path, path)):
+            params = {'file':path, 'bytes':os.path.getsize(os.path.join(webapp.app.root_path, path))}
+            addResult(results, "/download (x100)", params, timeFunction(lambda: [client.get("/download/" + path, headers={'Accept-Encoding':'gzip'}) for index in range(100)], repeat))
+
+def benchmarkRedis(results:list, work_dir:str, counts:list, repeat:int) -> None:
+    import redis
+    rd = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db, decode_responses=True)
+    try:
+        rd.ping()
+    except redis.exceptions.ConnectionError:
+        print("Redis is not reachable at {}:{}, skipping the loader benchmark".format(redis_host, redis_port))
+        return
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "old_versions", "redis"))
+    build_redis = importlib.import_module("build_redis")
+    for count in counts:
+        region_set = "synthetic_" + str(count)
+        # The results file generate_region_data.py writes, with every metric, RCP and product
+        makeSyntheticResults(work_dir, region_set, count)
+        build_redis.data_dir = work_dir + "/"
+        build_redis.results_suffix = gdata.results_suffix
+        build_redis.region_sets = [region_set]
+        params = {'region_set':region_set, 'regions':count, 'keys':len(list(build_redis.getDatasetFields()))}
+        addResult(results, "build_redis.loadDataset", params, timeFunction(lambda: build_redis.loadDataset(rd), repeat))
+        # Remove the last loaded dataset, so the benchmark database is left empty
+        version = rd.get(build_redis.alias_key)
+        build_redis.runOnKeys(rd, rd.scan_iter(match=version + ":*", count=1000), "unlink")
+        rd.delete(build_redis.alias_key)
+
+def compareResults(results:list, previous_path:str) -> None:
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)
+    previous_best = {(result['name'], json.dumps(result['params'], sort_keys=True)):result['best'] for result in previous['results']}
+    print("\nCompared with {} ({}):".format(previous['commit'], previous_path))
+    for result in results:
+        before = previous_best.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if before is not None:
+            print("{:<32} {:<60} {:9.4f} s -> {:9.4f} s ({:+.0f}%)".format(result['name'], json.dumps(result['params']), before, result['best'],
+                                                                        (result['best'] / before - 1) * 100))
+
+def main(argv:list=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the region data pipeline and the web app.")
+    parser.add_argument("--resolutions", type=float, nargs="+", default=resolutions, help="grid spacings (degrees) of the synthetic grids")
+    parser.add_argument("--region-counts", type=int, nargs="+", default=region_counts, help="sizes of the synthetic region sets")
+    parser.add_argument("--models", type=int, default=model_count, help="number of models in the synthetic ensembles")
+    parser.add_argument("--repeat", type=int, default=repeat, help="number of times each benchmark is run")
+    parser.add_argument("--legacy", action="store_true", help="also time the original per-cell region weighting (very slow)")
+    parser.add_argument("--skip-redis", action="store_true", help="don't benchmark the Redis loader")
+    parser.add_argument("--output", default=None, help="JSON file to save the results to (default: benchmarks/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    commit = getCommit()
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        region_sets = getRegionSets(work_dir, args.region_counts)
+        for resolution in args.resolutions:
+            models = makeSyntheticModels(resolution, args.models, seed=0)
+            historical_models = makeSyntheticModels(resolution, args.models, seed=1)
+            benchmarkEnsemble(results, work_dir, resolution, models, historical_models, args.repeat)
+            data = pdata.getMeanModel(pdata.getRelativeRatioModels(models, historical_models))
+            for region_set in region_sets:
+                benchmarkRegions(results, work_dir, resolution, data, region_set, args.repeat, args.legacy)
+        benchmarkWeb(results, work_dir, args.region_counts, args.repeat)
+        if not args.skip_redis:
+            benchmarkRedis(results, work_dir, args.region_counts, args.repeat)
+
+    output_path = args.output if args.output is not None else output_dir + commit + ".json"
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump({'commit':commit, 'date':time.strftime("%Y-%m-%dT%H:%M:%S"), 'python':platform.python_version(), 'platform':platform.platform(),
+                   'cpus':os.cpu_count(), 'results':results}, f, indent=2)
+    print("Saved results to " + output_path)
+    if args.compare is not None:
+        compareResults(results, args.compare)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends the web app reads the region data from.
+
+Every backend answers the same two questions for the web app: the whole list of regions for one
+dataset ("<metric>_<rcp>_<region set>_<data type>", the same JSON build_redis.py stores), and
+selected values of a single region. RedisBackend reads what build_redis.py loaded into Redis,
+ResultsBackend serves the region results files written by generate_region_data.py directly from
+memory, so a single node needs no Redis at all.
+"""
+import region_results as rresults
+import threading
+import hashlib
+import json
+import math
+import os
+
+def decodeRegionHash(values:dict) -> dict:
+    """
+    Parameters
+    ----------
+    values : dict
+        fields of a region hash as stored by build_redis.py, None for missing fields
+
+    Returns
+    -------
+    dict
+        'index', 'valid' and 'values' (field to value, NaN as None) of the region, or None if the region doesn't exist
+    """
+    if values.get("index") is None:
+        return None
+    values = {field:value for field, value in values.items() if value is not None}
+    region = {'index':int(values.pop("index")), 'valid':values.pop("valid") == "1", 'values':{}}
+    for field, value in values.items():
+        value = json.loads(value)
+        # NaN isn't valid JSON for the browser
+        region['values'][field] = None if value != value else value
+    return region
+
+def getResultsVersion(paths:list) -> str:
+    """
+    Parameters
+    ----------
+    paths : list of str
+        region results files
+
+    Returns
+    -------
+    str
+        version that changes whenever any of the files is written, created or removed
+    """
+    stats = []
+    for path in paths:
+        if os.path.isfile(path):
+            file_stat = os.stat(path)
+            stats.append((path, file_stat.st_mtime_ns, file_stat.st_size))
+    return "results:" + hashlib.sha256(repr(stats).encode()).hexdigest()[:16]
+
+class RedisBackend:
+    """
+    Datasets loaded by build_redis.py, read from the prefix the alias key points to.
+    """
+    def __init__(self, rd, alias_key:str, region_key_format:str):
+        self.rd = rd
+        self.alias_key = alias_key
+        self.region_key_format = region_key_format
+
+    def getVersion(self) -> str:
+        return self.rd.get(self.alias_key)
+
+    def getDataset(self, version:str, key:str) -> str:
+        # Keys from before versioned loading have no prefix
+        return self.rd.get(key if version is None else version + ":" + key)
+
+    def getRegion(self, version:str, region_set:str, region:str, fields:list) -> dict:
+        # Region hashes were added along with versioned loading
+        if version is None:
+            return None
+        redis_key = self.region_key_format.format(version, region_set, region)
+        if len(fields) == 0:
+            return decodeRegionHash(self.rd.hgetall(redis_key))
+        # The index is read along with the requested fields to tell a missing region from missing fields
+        return decodeRegionHash(dict(zip(["index", "valid"] + fields, self.rd.hmget(redis_key, ["index", "valid"] + fields))))
+
+class ResultsBackend:
+    """
+    Region results files ("<region set>_results.npz"), memory-mapped once and again whenever they change on disk, so only the
+    values that are requested are read.
+    """
+    def __init__(self, results_dir:str, region_sets:list, results_suffix:str="_results.npz"):
+        self.paths = {region_set:os.path.join(results_dir, region_set + results_suffix) for region_set in region_sets}
+        self.lock = threading.Lock()
+        self.version = None
+        self.results = {}
+        # Dataset key -> (region set, column)
+        self.datasets = {}
+
+    def getVersion(self) -> str:
+        # The version changes whenever a results file is written, which also clears the web app's cache
+        version = getResultsVersion(list(self.paths.values()))
+        with self.lock:
+            if version != self.version:
+                self.load()
+                self.version = version
+        return version
+
+    def load(self) -> None:
+        self.results = {}
+        self.datasets = {}
+        for region_set, path in self.paths.items():
+            if not os.path.isfile(path):
+                continue
+            # Files are replaced rather than rewritten, so a mapping stays valid after a newer file takes its place
+            results = rresults.loadRegionResults(path, mmap=True)
+            self.results[region_set] = results
+            for column, (metric, rcp, product) in enumerate(zip(results['metric'].tolist(), results['rcp'].tolist(), results['product'].tolist())):
+                self.datasets["{}_{}_{}_{}".format(metric, rcp, region_set, product)] = (region_set, column)
+
+    def getResults(self, version:str, region_set:str) -> dict:
+        # Results table of a region set as loaded for this version, None if it has been replaced since (or doesn't exist)
+        with self.lock:
+            return self.results.get(region_set) if version == self.version else None
+
+    def getDataset(self, version:str, key:str) -> str:
+        with self.lock:
+            if key not in self.datasets:
+                return None
+            region_set, column = self.datasets[key]
+            results = self.results[region_set]
+        # Same list of regions as the JSON files generate_region_data.py writes (NaN isn't valid JSON for the browser)
+        return json.dumps(rresults.getColumnRegions(results, column), allow_nan=False)
+
+    def getRegion(self, version:str, region_set:str, region:str, fields:list) -> dict:
+        with self.lock:
+            results = self.results.get(region_set)
+        if results is None or region not in results['rows']:
+            return None
+        row = results['rows'][region]
+        if len(fields) == 0:
+            fields = results['fields'].tolist()
+        values = {}
+        for field in fields:
+            if field in results['columns']:
+                value = results['values'][row, results['columns'][field]].item()
+                values[field] = None if math.isnan(value) else value
+        return {'index':row, 'valid':bool(results['valid'][row]), 'values':values}
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Generates simplified region geometry for the web app at several zoom levels.
+
+Each shapefile is converted to TopoJSON (shared borders are stored once as arcs) and GeoJSON,
+simplified along the shared arcs so neighbouring regions never gap or overlap, and quantized to a
+fraction of a screen pixel at each zoom level. A gzipped copy is written next to every file so the
+Flask app can serve it without compressing it per request.
+"""
+import generate_tiles as gtiles
+import geopandas
+import topojson
+import shapely
+import numpy
+import argparse
+import math
+import gzip
+import os
+
+shapefile_dir = "shapefiles/"
+output_dir = "geometry_levels/"
+shapefiles = ["CA_Counties_TIGER2016", "CA_Places_TIGER2016", "CA_Bulletin_118_Groundwater_Basins", "WBD_USGS_HUC10_CA"]
+var_name = ["NAME", "NAME", "Basin_Su_1", "Name"]
+
+# Zoom levels to generate geometry for, the web app serves the first level at or above the map's zoom
+zoom_levels = [5, 7, 9, 11]
+# Geometry is simplified to this fraction of a pixel at each zoom level, and coordinates are quantized 4x finer than that
+simplify_pixels = 0.5
+quantize_pixels = 0.125
+
+def getPixelSize(zoom:int) -> float:
+    """
+    Parameters
+    ----------
+    zoom : int
+        web map zoom level
+
+    Returns
+    -------
+    float
+        width of one pixel of a 256 px map tile at this zoom, in degrees of longitude
+    """
+    return 360 / (256 * 2 ** zoom)
+
+def getLevelPath(shapefile:str, zoom:int, extension:str) -> str:
+    # For example geometry_levels/CA_Counties_TIGER2016_z7.topojson
+    return output_dir + shapefile + "_z" + str(zoom) + "." + extension
+
+def readRegions(shapefile:str, s_var_name:str) -> geopandas.GeoDataFrame:
+    """
+    Parameters
+    ----------
+    shapefile : str
+        name of shapefile in shapefile_dir
+    s_var_name : str
+        name of variable in the shapefile labeling each region
+
+    Returns
+    -------
+    geopandas.GeoDataFrame
+        regions in lat/lon with only the properties the web app needs: 'index' (row in the region data) and 'NAME'.
+        Invalid geometry is repaired (keeping only its polygons), regions without any geometry are left out but the
+        'index' of every other region is still its row in the shapefile, and so in the region data.
+    """
+    regions = geopandas.read_file(shapefile_dir + shapefile + ".shp").to_crs("epsg:4326")
+    # Records without geometry are read as None, which topojson can't convert
+    geometries = gtiles.getPolygonalGeometries(shapely.make_valid(regions.geometry.values))
+    present = ~(shapely.is_missing(geometries) | shapely.is_empty(geometries))
+    return geopandas.GeoDataFrame({'index':numpy.flatnonzero(present), 'NAME':regions[s_var_name].astype(str).values[present]}, geometry=geometries[present], crs=regions.crs)
+
+def simplifyRegions(regions:geopandas.GeoDataFrame, zoom:int) -> topojson.Topology:
+    """
+    Parameters
+    ----------
+    regions : geopandas.GeoDataFrame
+        regions to simplify, in lat/lon
+    zoom : int
+        zoom level the geometry will be displayed at
+
+    Returns
+    -------
+    topojson.Topology
+        topology with shared arcs, simplified and quantized for the zoom level
+    """
+    pixel = getPixelSize(zoom)
+    min_lon, min_lat, max_lon, max_lat = regions.total_bounds
+    # Number of quantization steps across the extent of the region set
+    quantization = int(max(max_lon - min_lon, max_lat - min_lat) / (pixel * quantize_pixels)) + 1
+    # Arcs are simplified after being split at junctions, so shared borders are simplified identically for both regions
+    return topojson.Topology(regions, topology=True, prequantize=quantization, toposimplify=pixel * simplify_pixels, prevent_oversimplify=True)
+
+def writeWithGzip(path:str, text:str) -> None:
+    data = text.encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+    # Written after the original, so the web app sees it as up to date
+    with open(path + ".gz", 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+def generateLevels(shapefile:str, s_var_name:str) -> None:
+    regions = readRegions(shapefile, s_var_name)
+    for zoom in zoom_levels:
+        topology = simplifyRegions(regions, zoom)
+        writeWithGzip(getLevelPath(shapefile, zoom, "topojson"), topology.to_json())
+        # GeoJSON has no quantized integer coordinates, so round to the same precision instead
+        decimals = math.ceil(-math.log10(getPixelSize(zoom) * quantize_pixels))
+        writeWithGzip(getLevelPath(shapefile, zoom, "geojson"), topology.to_geojson(decimals=decimals))
+        print("{} zoom {}: {:.1f} KB TopoJSON, {:.1f} KB GeoJSON".format(shapefile, zoom, os.path.getsize(getLevelPath(shapefile, zoom, "topojson")) / 1024,
+                                                                       os.path.getsize(getLevelPath(shapefile, zoom, "geojson")) / 1024))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate simplified region geometry at several zoom levels for the web app.")
+    parser.add_argument("shapefiles", nargs="*", default=shapefiles, help="shapefiles to process (default: every region set)")
+    args = parser.parse_args()
+    os.makedirs(output_dir, exist_ok=True)
+    for shapefile in args.shapefiles:
+        generateLevels(shapefile, var_name[shapefiles.index(shapefile)])
@@ -14,9 +14,21 @@ import rioxarray
 from shapely.geometry import mapping, Polygon
 import shapely.errors
 import persad_data_analyze as pdata
+import region_weights as rweights
+import pipeline_manifest as pmanifest
+import region_results as rresults
+import region_series as rseries
+import pipeline_profile as pprofile
 import warnings
 import json
-from multiprocessing import Process
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import traceback
+import cProfile
+import time
+import glob
+import sys
+import os
 
 def adjustCoordinates(data:xr.core.dataarray.DataArray) -> xr.core.dataarray.DataArray:
     """
@@ -32,7 +44,7 @@ def adjustCoordinates(data:xr.core.dataarray.DataArray) -> xr.core.dataarray.Dat
     """
     return data.assign_coords(lon=(((data.lon + 180) % 360) - 180)).sortby('lon')
 
-def analyzeRegions(region_shapefile_path:str, shapefile_variable:str, cumulative_data:xr.core.dataarray.DataArray) -> list:
+def analyzeRegionsPerCell(region_shapefile_path:str, shapefile_variable:str, cumulative_data:xr.core.dataarray.DataArray) -> list:
     """
     Parameters
     ----------
@@ -48,6 +60,7 @@ def analyzeRegions(region_shapefile_path:str, shapefile_variable:str, cumulative
         Returns JSON-style list with info concerning each region defined in the shapefile that had relevent data specified in the array
 
     """
+    # Original weighting: clips the data to each region and intersects one grid cell polygon at a time (slow)
     # Adjust coordinates to match the shapefile coordinates
     data = adjustCoordinates(cumulative_data)
     # Set spatial dimensions for data
@@ -67,9 +80,11 @@ def analyzeRegions(region_shapefile_path:str, shapefile_variable:str, cumulative
     cell_radius_lat = (data.coords['lat'][1].item() - data.coords['lat'][0].item()) / 2
     cell_radius_lon = (data.coords['lon'][1].item() - data.coords['lon'][0].item()) / 2
     
+    region_set = os.path.splitext(os.path.basename(region_shapefile_path))[0]
     # Iterate over every region labeled by the specified variable
     for index, var in enumerate(shapefile[shapefile_variable]):
         print("Calculating region #" + str(index) + ": " + str(var))
+        region_start = time.perf_counter()
         # Get polygon geometry for this region
         polys = [shapefile["geometry"][index]]
         # Format geometry set
@@ -78,46 +93,251 @@ def analyzeRegions(region_shapefile_path:str, shapefile_variable:str, cumulative
         geom_dataframe = geopandas.GeoDataFrame(geom, crs=shapefile.crs)
         
         # Mask data to region, including all regions it touches, not just encapsulates
-        mask = data.rio.clip(geom_dataframe.geometry.apply(mapping), shapefile.crs, drop=True, all_touched=True)
-        # Adjust data frame to appropraite CRS one more time to make sure it's accurate (the warning still appears so whatever)
+        with pprofile.stage("clip", region_set=region_set):
+            mask = data.rio.clip(geom_dataframe.geometry.apply(mapping), shapefile.crs, drop=True, all_touched=True)
+        # Adjust data frame to appropraite CRS one more time to make sure it's accurate
         geom_dataframe = geom_dataframe.to_crs("epsg:4326")
-        # Get total area of region
-        total_area = geom_dataframe.area.item()
+        # Get total area of region, in square degrees like the cell areas it is compared to (so geopandas' geographic CRS warning doesn't apply)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Geometry is in a geographic CRS", category=UserWarning)
+            total_area = geom_dataframe.area.item()
         
         # Whether or not the value was properly calculated
         valid = True
         
         # Weighted average of value of metric for this given region
         value = 0
-        # Iterate through each point in the masked data
-        for lats in mask:
-            for pt in lats:
-                # Get coordinates
-                lat = pt['lat'].item()
-                lon = pt['lon'].item()
-                # Calculate corners of the data grid cell
-                tl_corner = (lon - cell_radius_lon, lat + cell_radius_lat)
-                tr_corner = (lon + cell_radius_lon, lat + cell_radius_lat)
-                br_corner = (lon + cell_radius_lon, lat - cell_radius_lat)
-                bl_corner = (lon - cell_radius_lon, lat - cell_radius_lat)
-                # Create a polygon "box" that defines the grid cell
-                cell = Polygon([tl_corner, tr_corner, br_corner, bl_corner])
-                # Find the area of the overlap between the region and the data grid cell, it will throw an error if the geometry is invalid
-                try:
-                    overlap_area = geom_dataframe.geometry[0].intersection(cell).area
-                except shapely.errors.TopologicalError:
-                    valid = False
-                    break
-                # If the value of the metric's point is not NaN
-                if not np.isnan(pt.item()):
-                    # Add this weighted value to the weighted average
-                    value += (overlap_area / total_area) * pt.item()
+        with pprofile.stage("overlap", region_set=region_set):
+            # Iterate through each point in the masked data
+            for lats in mask:
+                for pt in lats:
+                    # Get coordinates
+                    lat = pt['lat'].item()
+                    lon = pt['lon'].item()
+                    # Calculate corners of the data grid cell
+                    tl_corner = (lon - cell_radius_lon, lat + cell_radius_lat)
+                    tr_corner = (lon + cell_radius_lon, lat + cell_radius_lat)
+                    br_corner = (lon + cell_radius_lon, lat - cell_radius_lat)
+                    bl_corner = (lon - cell_radius_lon, lat - cell_radius_lat)
+                    # Create a polygon "box" that defines the grid cell
+                    cell = Polygon([tl_corner, tr_corner, br_corner, bl_corner])
+                    # Find the area of the overlap between the region and the data grid cell, it will throw an error if the geometry is invalid (GEOSException in shapely 2)
+                    try:
+                        overlap_area = geom_dataframe.geometry[0].intersection(cell).area
+                    except (shapely.errors.TopologicalError, shapely.errors.GEOSException):
+                        valid = False
+                        break
+                    # If the value of the metric's point is not NaN
+                    if not np.isnan(pt.item()):
+                        # Add this weighted value to the weighted average
+                        value += (overlap_area / total_area) * pt.item()
         # Once the analysis for this region is complete, generate a set and add it to the list
         regions_analysis.append({ 'index':index, 'NAME':var, 'value':value, 'valid':valid})
         # Also add the value for the metric for other data analysis stuff
         values.append(value)
+        pprofile.recordRegion(region_set, str(var), wall=time.perf_counter() - region_start, cells=int(mask.size))
     return (regions_analysis, values)
 
+def analyzeRegions(region_shapefile_path:str, shapefile_variable:str, cumulative_data:xr.core.dataarray.DataArray, weight_mode:str="sparse", cache_dir:str=None,
+                   area_mode:str="degrees", supersample:int=4, statistics:list=None) -> list:
+    """
+    Parameters
+    ----------
+    region_shapefile_path : str
+        path to shapefile to use for defining regions
+    shapefile_variable : str
+        name of variable to extract from shapefile for labeling regions
+    cumulative_data : xr.core.dataarray.DataArray
+        data array to find metrics for each region in, with an optional time dimension (each region's value is then a list over time)
+    weight_mode : str, optional
+        "sparse" computes every cell/region overlap in one batched pass and averages with a sparse matrix product,
+        "raster" approximates the overlaps with supersampled region masks (faster for large or detailed region sets),
+        "cell" uses the original per-cell polygon intersection loop. The default is "sparse".
+    cache_dir : str, optional
+        directory to cache the region weights in (sparse and raster modes only), weights are recalculated every time if not specified. The default is None.
+    area_mode : str, optional
+        "degrees" measures overlaps in lat/lon degrees, "equal_area" in an equal-area projection (sparse and raster modes only). The default is "degrees".
+    supersample : int, optional
+        subcells per grid cell along each axis in raster mode. The default is 4.
+    statistics : list of str, optional
+        extra area-weighted statistics to add to each region (sparse and raster modes only), see region_weights.parseStatistic. The default is None.
+    Returns
+    -------
+    list
+        Returns JSON-style list with info concerning each region defined in the shapefile that had relevent data specified in the array
+
+    """
+    if weight_mode == "cell":
+        return analyzeRegionsPerCell(region_shapefile_path, shapefile_variable, cumulative_data)
+    elif weight_mode not in ("sparse", "raster"):
+        raise ValueError("Unknown weight mode: " + str(weight_mode))
+    
+    # A single field is just a stack of size one
+    region_table = analyzeRegionsStacked(region_shapefile_path, shapefile_variable, cumulative_data.expand_dims(field=[0]), cache_dir=cache_dir, area_mode=area_mode,
+                                         weight_mode=weight_mode, supersample=supersample, statistics=statistics)
+    return getRegionList(region_table.isel(field=0))
+
+def analyzeRegionsStacked(region_shapefile_path:str, shapefile_variable:str, stacked_data:xr.core.dataarray.DataArray, cache_dir:str=None,
+                          area_mode:str="degrees", weight_mode:str="sparse", supersample:int=4, statistics:list=None) -> xr.core.dataarray.DataArray:
+    """
+    Parameters
+    ----------
+    region_shapefile_path : str
+        path to shapefile to use for defining regions
+    shapefile_variable : str
+        name of variable to extract from shapefile for labeling regions
+    stacked_data : xr.core.dataarray.DataArray
+        data array with dimensions (field, lat, lon), every field (metric, RCP, product, ...) is averaged over each region in one pass.
+        An optional time dimension is averaged for every time step in the same pass, see analyzeRegionsOverTime for long series
+    cache_dir : str, optional
+        directory to cache the region weights in, weights are recalculated every time if not specified. The default is None.
+    area_mode : str, optional
+        "degrees" measures overlaps in lat/lon degrees, "equal_area" in an equal-area projection. The default is "degrees".
+    weight_mode : str, optional
+        "sparse" for exact overlaps, "raster" for overlaps approximated with supersampled region masks. The default is "sparse".
+    supersample : int, optional
+        subcells per grid cell along each axis in raster mode. The default is 4.
+    statistics : list of str, optional
+        extra area-weighted statistics (std, min, max, percentiles, area fractions, see region_weights.parseStatistic) to calculate
+        from the same weights. The default is None.
+    Returns
+    -------
+    xr.core.dataarray.DataArray
+        (field, region) table, or (time, field, region) with a time dimension, of the weighted average of each field for every region, with the region names, validity and
+        weight error bound (0 for exact weights) as coordinates. With statistics, a leading 'statistic' dimension holds "mean" followed by each statistic
+
+    """
+    # Adjust coordinates to match the shapefile coordinates, and make sure the grid is flattened in (lat, lon) order
+    data = adjustCoordinates(stacked_data).transpose(*(('time',) if 'time' in stacked_data.dims else ()), 'field', 'lat', 'lon')
+    
+    region_set = os.path.splitext(os.path.basename(region_shapefile_path))[0]
+    print("Calculating weights for " + region_shapefile_path)
+    # Fraction of each region covered by each grid cell, as a sparse (region, cell) matrix (reused from the cache if the grid and shapefile haven't changed)
+    with pprofile.stage("weights", region_set=region_set, weight_mode=weight_mode):
+        weights, valid, names, error_bound = rweights.getRegionWeights(region_shapefile_path, shapefile_variable, data['lat'].values, data['lon'].values,
+                                                                       cache_dir=cache_dir, area_mode=area_mode, method="raster" if weight_mode == "raster" else "exact",
+                                                                       supersample=supersample)
+    # Every region's weights should sum to 1, less means part of it is outside the data (for example the models were cropped too tightly)
+    coverage = np.asarray(weights.sum(axis=1)).ravel()
+    incomplete = np.flatnonzero(np.abs(coverage - 1) > np.maximum(weight_sum_tolerance, error_bound))
+    if len(incomplete) > 0:
+        # Printed rather than warned, so it shows up in the worker output whatever warning filters the task runs with
+        print("Warning: {} of {} regions in {} are not fully covered by the data grid: {}".format(
+            len(incomplete), len(names), region_set, ", ".join("{} ({:.1%})".format(names[index], coverage[index]) for index in incomplete[:10])))
+    if weight_mode == "raster" and len(error_bound) > 0:
+        # The averages can be off by at most error_bound times the largest difference between the fields' values in the region
+        worst = int(np.argmax(error_bound))
+        print("Largest raster weight error bound: {:.3g} ({})".format(error_bound[worst], names[worst]))
+    # Regions are weighted all at once, so the cost of each region is recorded as the number of grid cells it overlaps,
+    # along with the share of its area the data covers (so incomplete regions are in the profile report as well)
+    for name, cells, bound, covered in zip(names.tolist(), weights.getnnz(axis=1).tolist(), error_bound.tolist(), coverage.tolist()):
+        pprofile.recordRegion(region_set, name, cells=cells, error_bound=bound, coverage=covered)
+    # Weighted average of every field for every region in one sparse matrix product
+    with pprofile.stage("overlap", region_set=region_set, fields=data.sizes['field']):
+        if statistics is None:
+            values = np.moveaxis(rweights.applyWeights(weights, data.values), 0, -1)
+            dims = data.dims[:-2] + ('region',)
+            coords = {}
+        else:
+            # Every statistic comes from the same weights and cell values, the mean is always first
+            statistic_names = ["mean"] + [name for name in statistics if name != "mean"]
+            computed = rweights.applyWeightStatistics(weights, data.values, statistic_names)
+            values = np.stack([np.moveaxis(computed[name], 0, -1) for name in statistic_names])
+            dims = ('statistic',) + data.dims[:-2] + ('region',)
+            coords = {'statistic':statistic_names}
+    
+    # Regions become the last dimension, after time (if any) and field
+    region_table = xr.DataArray(values, dims=dims,
+                                coords={**coords, 'field':data['field'].values, 'region':np.arange(len(names)), 'NAME':('region', names), 'valid':('region', valid),
+                                        'error_bound':('region', error_bound)})
+    # Keep the time steps and any labels describing the fields (metric, RCP, product)
+    return region_table.assign_coords({name:coord for name, coord in data.coords.items() if coord.dims in (('field',), ('time',))})
+
+def analyzeRegionsOverTime(region_shapefile_path:str, shapefile_variable:str, series_data:xr.core.dataarray.DataArray, output_path:str, time_chunk:int=120,
+                           cache_dir:str=None, area_mode:str="degrees", weight_mode:str="sparse", supersample:int=4) -> str:
+    """
+    Parameters
+    ----------
+    region_shapefile_path : str
+        path to shapefile to use for defining regions
+    shapefile_variable : str
+        name of variable to extract from shapefile for labeling regions
+    series_data : xr.core.dataarray.DataArray
+        lazily loaded data array with dimensions (time, lat, lon) or (time, field, lat, lon), only time_chunk time steps are read at once
+    output_path : str
+        NetCDF file to write the (time, field, region) averages to, see region_series.loadRegionSeries
+    time_chunk : int, optional
+        number of time steps averaged (with one sparse matrix product) and appended to the file at once. The default is 120.
+    cache_dir : str, optional
+        directory to cache the region weights in. The default is None.
+    area_mode : str, optional
+        "degrees" or "equal_area", see analyzeRegionsStacked. The default is "degrees".
+    weight_mode : str, optional
+        "sparse" or "raster", see analyzeRegionsStacked. The default is "sparse".
+    supersample : int, optional
+        subcells per grid cell along each axis in raster mode. The default is 4.
+    Returns
+    -------
+    str
+        output_path, which only appears once every time step has been written
+
+    """
+    if 'field' not in series_data.dims:
+        series_data = series_data.expand_dims(field=[series_data.name if series_data.name is not None else "value"])
+    data = adjustCoordinates(series_data).transpose('time', 'field', 'lat', 'lon')
+    
+    region_set = os.path.splitext(os.path.basename(region_shapefile_path))[0]
+    # The weights are calculated (or loaded from the cache) once and applied to every time step
+    with pprofile.stage("weights", region_set=region_set, weight_mode=weight_mode):
+        weights, valid, names, error_bound = rweights.getRegionWeights(region_shapefile_path, shapefile_variable, data['lat'].values, data['lon'].values,
+                                                                       cache_dir=cache_dir, area_mode=area_mode, method="raster" if weight_mode == "raster" else "exact",
+                                                                       supersample=supersample)
+    # Written to a temporary file first so that readers never see a partial series
+    temp_path = output_path + ".tmp"
+    rseries.createRegionSeries(temp_path, names, valid, data['field'].values, time_chunk)
+    with pprofile.stage("series", region_set=region_set, steps=data.sizes['time']):
+        for start in range(0, data.sizes['time'], time_chunk):
+            chunk = data.isel(time=slice(start, start + time_chunk))
+            # Every time step and field of the chunk is averaged in one sparse matrix product, as (region, time, field)
+            values = rweights.applyWeights(weights, chunk.values)
+            rseries.appendRegionSeries(temp_path, chunk['time'].values, np.moveaxis(values, 0, -1))
+    os.replace(temp_path, output_path)
+    return output_path
+
+def getRegionList(region_values:xr.core.dataarray.DataArray) -> tuple:
+    """
+    Parameters
+    ----------
+    region_values : xr.core.dataarray.DataArray
+        one field of the table returned by analyzeRegionsStacked, with or without time and statistic dimensions
+    Returns
+    -------
+    tuple
+        JSON-style list with info concerning each region (and a key for each extra statistic) and the list of just the values for each region
+
+    """
+    statistics = region_values['statistic'].values.tolist() if 'statistic' in region_values.dims else []
+    # With a time dimension each region's value is its list of values over time
+    values = getJSONValues((region_values.sel(statistic="mean") if len(statistics) > 0 else region_values).transpose('region', ...).values)
+    regions_analysis = [{ 'index':index, 'NAME':str(var), 'value':values[index], 'valid':bool(valid)}
+                        for index, (var, valid) in enumerate(zip(region_values['NAME'].values, region_values['valid'].values))]
+    for statistic in statistics:
+        if statistic != "mean":
+            for region, value in zip(regions_analysis, getJSONValues(region_values.sel(statistic=statistic).transpose('region', ...).values)):
+                region[statistic] = value
+    return (regions_analysis, values)
+
+def getJSONValues(values:np.ndarray) -> list:
+    # NaN isn't valid JSON for the browser, regions without any data (for example a statistic over only NaN cells) get null
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isnan(values), None, values).tolist()
+
+def getProductStatistics(region_values:xr.core.dataarray.DataArray) -> xr.core.dataarray.DataArray:
+    # Area fractions with a threshold ("ge<k>") count models in agreement, so they are only kept for agreement products
+    if 'statistic' not in region_values.dims or str(region_values['product'].item()) in agreement_products:
+        return region_values
+    return region_values.sel(statistic=[name for name in region_values['statistic'].values.tolist() if rweights.parseStatistic(name)[0] != "at_least"])
+
 # List of models to use
 models = ['ACCESS1-0', 'CCSM4', 'CESM1-BGC','CMCC-CMS','CNRM-CM5', 'CanESM2', 'GFDL-CM3','HadGEM2-CC','HadGEM2-ES','MIROC5']
 
@@ -136,44 +356,414 @@ metrics = ['frac_extreme', 'max_threeday_precip', 'nov_mar_percent',
 
 data_dir = "/home/p1/persad_research/water_research/datadrive/Analysis_Output/"
 output_dir = "json_data/"
+# Every field for a region set is also stored in one columnar file (one row per region, one column per metric, RCP and product)
+results_suffix = "_results.npz"
+# Records what each output was generated from, so reruns only recalculate outputs whose inputs changed
+manifest_name = "run_manifest.json"
+# Stage timings and memory of the last run, written next to the outputs
+profile_report_name = "run_profile.json"
+# Chunk sizes to load the NetCDF files lazily with dask (for example {'lat': 100, 'lon': 100}), None reads the selected models into memory
+netcdf_chunks = None
+# Type the models are read and averaged in, float32 halves the memory of every ensemble task (np.float64 for full precision)
+ensemble_dtype = np.float32
+# Region weights only depend on the grid and shapefile, so they are cached here and shared by every metric and RCP
+weight_cache_dir = "weight_cache/"
+# Overlap areas are measured in an equal-area projection, degrees of longitude shrink with latitude so areas in degrees are distorted
+weight_area_mode = "equal_area"
+# "sparse" computes the exact overlap of every region with every grid cell, "raster" approximates it with supersampled
+# region masks (much faster for region sets with many detailed polygons, see region_weights.calculateRasterWeights)
+weight_mode = "sparse"
+# Subcells per grid cell along each axis in raster mode, the error bound shrinks in proportion
+raster_supersample = 8
+# Largest difference from 1 allowed in the sum of a region's weights before warning that the region isn't fully covered
+weight_sum_tolerance = 1e-3
 
 shapefile_dir = "../shapefiles/"
 shapefiles = ["CA_Counties_TIGER2016", "CA_Places_TIGER2016", "CA_Bulletin_118_Groundwater_Basins", "WBD_USGS_HUC10_CA"]
 var_name = ["NAME", "NAME", "Basin_Su_1", "Name"]
 
+# Region averages over time (--series) are written to output_dir + <NetCDF name>_<shapefile> + series_suffix
+series_suffix = "_series.nc"
+# Time steps read, averaged and appended to a series file at once
+series_time_chunk = 120
+
+# Products calculated for each metric and RCP
+products = ["totalaverage", "totalagreement"]
+# Extra area-weighted statistics written for every region along with the mean (--stats), for example ["std", "min", "max", "iqr", "ge8"]
+region_statistics = []
+# Products whose values count agreeing models, the only ones the "ge<k>" area fractions are written for
+agreement_products = ["totalagreement"]
+
+def calculateEnsembleFields(metric:str, rcp:str, bounds:tuple=None) -> xr.core.dataarray.DataArray:
+    """
+    Parameters
+    ----------
+    metric : str
+        name of metric to load
+    rcp : str
+        RCP suffix of the metric files to load
+    bounds : tuple, optional
+        (lat_min, lat_max, lon_min, lon_max) to crop the models to (see getShapefileBounds), the whole grid is read if not specified. The default is None.
+    Returns
+    -------
+    xr.core.dataarray.DataArray
+        (field, lat, lon) stack of the average relative change and model agreement for this metric and RCP
+
+    """
+    with pprofile.stage("ensemble", metric=metric, rcp=rcp):
+        # Only the models listed are read, and only the grid cells covering the region sets. Each model name must match exactly
+        # one variable in both files, so every projection model is compared to the historical run of the same model
+        if netcdf_chunks is None:
+            # Each model is read when it is reached and released once it is added to the running sums, every read is its own "load" stage
+            metric_models = pprofile.iterStage("load", pdata.iterModelsFromNetCDF(data_dir + metric + rcp + ".nc", models, bounds=bounds, dtype=ensemble_dtype, unique=True),
+                                               metric=metric, rcp=rcp, file="projection")
+            metric_hist_models = pprofile.iterStage("load", pdata.iterModelsFromNetCDF(data_dir + metric + rcp + hist_suffix + ".nc", models, bounds=bounds, dtype=ensemble_dtype, unique=True),
+                                                    metric=metric, rcp=rcp, file="historical")
+        else:
+            with pprofile.stage("load", metric=metric, rcp=rcp):
+                metric_models = pdata.getModelsFromNetCDF(data_dir + metric + rcp + ".nc", models, chunks=netcdf_chunks, bounds=bounds, unique=True)
+                metric_hist_models = pdata.getModelsFromNetCDF(data_dir + metric + rcp + hist_suffix + ".nc", models, chunks=netcdf_chunks, bounds=bounds, unique=True)
+        # Calculate the average change from historical to future and the agreement amongst all models in one pass,
+        # if this specific metric is SWE, only take positive data
+        ensemble = pdata.getRelativeRatioEnsemble(metric_models, metric_hist_models, dtype=ensemble_dtype, min_historical=1 if metric == 'SWE_total' else None)
+        avg_model_per_change = ensemble['mean']
+        model_agreement = ensemble['agreement']
+        
+        # Stack both products (in the same order as 'products') so they are averaged over the regions together
+        fields = xr.concat([avg_model_per_change.rename(None), model_agreement.rename(None)], dim='field', coords='minimal', compat='override')
+        # Compute any lazy (dask) results here so only the final fields are passed back from the worker
+        fields = fields.load()
+    return fields.assign_coords(field=[metric + rcp + "_" + product for product in products],
+                                metric=('field', [metric] * len(products)), rcp=('field', [rcp] * len(products)), product=('field', products))
+
+def calculate_over_shapefile(shapefile, s_var_name, stacked_fields, statistics=None):
+    # Average every metric, RCP and product over the regions in one pass, along with any extra statistics
+    region_table = analyzeRegionsStacked(shapefile_dir + shapefile + ".shp", s_var_name, stacked_fields, cache_dir=weight_cache_dir, area_mode=weight_area_mode,
+                                         weight_mode=weight_mode, supersample=raster_supersample, statistics=statistics if statistics else None)
+    
+    with pprofile.stage("write", region_set=shapefile, fields=region_table.sizes['field']):
+        for field in region_table['field'].values:
+            region_values = getProductStatistics(region_table.sel(field=field))
+            region_list, region_list_values = getRegionList(region_values)
+            output_prefix = output_dir + str(region_values['metric'].item()) + str(region_values['rcp'].item()) + shapefile + "_" + str(region_values['product'].item())
+            # Dump the information into a JSON file
+            with open(output_prefix + ".json", 'w') as output:
+                json.dump(region_list, output, indent=2, allow_nan=False)
+            with open(output_prefix + "_list.json", 'w') as output:
+                json.dump(region_list_values, output, indent=2, allow_nan=False)
+        
+        # Also store every field in one columnar file for the whole region set
+        writeRegionResults(shapefile, region_table)
+
+def calculate_series_over_shapefile(series_path:str, shapefile:str, s_var_name:str) -> list:
+    """
+    Parameters
+    ----------
+    series_path : str
+        NetCDF file of gridded time series, every variable with time, lat and lon dimensions is averaged over the regions
+    shapefile : str
+        name of the shapefile (in shapefile_dir) defining the regions
+    s_var_name : str
+        name of variable to extract from shapefile for labeling regions
+    Returns
+    -------
+    list
+        paths of the series files written
+
+    """
+    written = []
+    # Opened lazily, only one chunk of time steps of one variable is read at a time
+    with xr.open_dataset(series_path, cache=False) as dataset:
+        for variable in dataset.data_vars:
+            # Only gridded time series, not for example the time bounds (time, nv) of CF files
+            if not {'time', 'lat', 'lon'}.issubset(dataset[variable].dims):
+                continue
+            output_path = output_dir + os.path.splitext(os.path.basename(series_path))[0] + "_" + str(variable) + "_" + shapefile + series_suffix
+            written.append(analyzeRegionsOverTime(shapefile_dir + shapefile + ".shp", s_var_name, dataset[variable], output_path, time_chunk=series_time_chunk,
+                                                  cache_dir=weight_cache_dir, area_mode=weight_area_mode, weight_mode=weight_mode, supersample=raster_supersample))
+    return written
+
+def writeRegionResults(shapefile:str, region_table:xr.core.dataarray.DataArray) -> None:
+    """
+    Parameters
+    ----------
+    shapefile : str
+        name of the region set
+    region_table : xr.core.dataarray.DataArray
+        (field, region) table from analyzeRegionsStacked, these columns replace the same columns already in the file. Each extra
+        statistic is stored in its own column, with the statistic appended to the field and product (for example 'et_RCP85_totalaverage_std')
+    Returns
+    -------
+    None
+
+    """
+    path = output_dir + shapefile + results_suffix
+    names = region_table['NAME'].values
+    # Column label -> (values, metric, rcp, product), starting from the columns already saved so incremental runs keep them
+    columns = {}
+    if os.path.isfile(path):
+        previous = rresults.loadRegionResults(path)
+        # If the regions changed, the old columns no longer line up (every field is recalculated in that case anyway)
+        if np.array_equal(previous['NAME'], names):
+            for column, field in enumerate(previous['fields'].tolist()):
+                columns[field] = (previous['values'][:, column], previous['metric'][column], previous['rcp'][column], previous['product'][column])
+    for field in region_table['field'].values.tolist():
+        region_values = getProductStatistics(region_table.sel(field=field))
+        # Statistic columns of this field from the last run go, in case fewer statistics were requested this time
+        for label in [label for label in columns if label.startswith(field + "_") and columns[label][3].startswith(region_values['product'].item() + "_")]:
+            del columns[label]
+        if 'statistic' not in region_values.dims:
+            columns[field] = (region_values.values, region_values['metric'].item(), region_values['rcp'].item().lstrip('_'), region_values['product'].item())
+            continue
+        for statistic in region_values['statistic'].values.tolist():
+            suffix = "" if statistic == "mean" else "_" + statistic
+            columns[field + suffix] = (region_values.sel(statistic=statistic).values, region_values['metric'].item(), region_values['rcp'].item().lstrip('_'),
+                                       region_values['product'].item() + suffix)
+    
+    fields = list(columns.keys())
+    rresults.saveRegionResults(path, names, region_table['valid'].values, fields, np.stack([columns[field][0] for field in fields], axis=1),
+                               [columns[field][1] for field in fields], [columns[field][2] for field in fields], [columns[field][3] for field in fields])
+
 def calculate_over_rcp(metric, rcp, shapefile, s_var_name):
-    metric_models = pdata.getModelsFromNetCDF(data_dir + metric + rcp + ".nc", models)
-    metric_hist_models = pdata.getModelsFromNetCDF(data_dir + metric + rcp + hist_suffix + ".nc", models)
-    # If this specific metric is SWE, only take positive data
-    if metric == 'SWE_total':
-        for index in range(len(metric_hist_models)):
-            metric_hist_models[index] = metric_hist_models[index].where(metric_hist_models[index] > 1)
-            metric_models[index] = metric_models[index].where(metric_hist_models[index])
-    # Calculate average of all models
-    mean_model = pdata.getMeanModel(metric_models)
-    # Calculate agreement amongst all models
-    model_agreement = pdata.getModelsAgreement(mean_model, metric_models)
-    # Calculate average change from historical to future for each model
-    avg_model_per_change = pdata.getMeanModel(pdata.getRelativeRatioModels(metric_models, metric_hist_models))
-    
-    region_averages, region_averages_valid = analyzeRegions(shapefile_dir + shapefile + ".shp", s_var_name, avg_model_per_change)
-    region_agreement, region_agreement_valid = analyzeRegions(shapefile_dir + shapefile + ".shp", s_var_name, model_agreement)
-    
-    # Dump the information into a JSON file
-    with open(output_dir + metric + rcp + shapefile + "_totalaverage.json", 'w') as output:
-        json.dump(region_averages, output, indent=2)
-    with open(output_dir + metric + rcp + shapefile + "_totalaverage_list.json", 'w') as output:
-        json.dump(region_averages_valid, output, indent=2)
-    with open(output_dir + metric + rcp + shapefile + "_totalagreement.json", 'w') as output:
-        json.dump(region_agreement, output, indent=2)
-    with open(output_dir + metric + rcp + shapefile + "_totalagreement_list.json", 'w') as output:
-        json.dump(region_agreement_valid, output, indent=2)
+    calculate_over_shapefile(shapefile, s_var_name, calculateEnsembleFields(metric, rcp, getShapefileBounds([shapefile])))
                 
 
-# The area function returns a warning even when the CRS is set, so I just "muted" it
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
+def runTimed(function, args:tuple, profile_path:str=None) -> tuple:
+    """
+    Parameters
+    ----------
+    function : callable
+        task to run in a worker process
+    args : tuple
+        arguments to call the task with
+    profile_path : str, optional
+        file to save a cProfile profile of the task to (readable with pstats or snakeviz), not profiled if not specified. The default is None.
+    Returns
+    -------
+    tuple
+        (result, wall time in seconds, traceback string or None if the task succeeded, stage and region records of the task)
+
+    """
+    # Drop anything recorded by an earlier task in this worker process
+    pprofile.takeRecords()
+    profiler = cProfile.Profile() if profile_path is not None else None
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        result = function(*args)
+        return (result, time.perf_counter() - start, None, pprofile.takeRecords())
+    except Exception:
+        return (None, time.perf_counter() - start, traceback.format_exc(), pprofile.takeRecords())
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+
+def runTasks(tasks:list, workers:int, profile_dir:str=None) -> tuple:
+    """
+    Parameters
+    ----------
+    tasks : list of tuples
+        (name, function, args) for each task, tasks are started in the order given
+    workers : int
+        maximum number of worker processes to run at once
+    profile_dir : str, optional
+        directory to save a cProfile profile of every task to ("<task name>.prof"), tasks aren't profiled if not specified. The default is None.
+    Returns
+    -------
+    tuple
+        (results, timings, failures, records) dictionaries keyed by task name
+
+    """
+    results = {}
+    timings = {}
+    failures = {}
+    records = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(runTimed, function, args, None if profile_dir is None else os.path.join(profile_dir, name + ".prof")):name
+                   for name, function, args in tasks}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result, wall_time, error, records[name] = future.result()
+            except Exception:
+                # The worker itself died (for example killed for running out of memory)
+                result, wall_time, error = (None, float('nan'), traceback.format_exc())
+            timings[name] = wall_time
+            if error is None:
+                results[name] = result
+                print("Finished {} in {:.1f} s".format(name, wall_time))
+            else:
+                failures[name] = error
+                print("FAILED {} after {:.1f} s".format(name, wall_time))
+    return (results, timings, failures, records)
+
+def getShapefileBounds(shapefile_names:list) -> tuple:
+    """
+    Parameters
+    ----------
+    shapefile_names : list of str
+        names of the shapefiles (in shapefile_dir) the models will be averaged over
+
+    Returns
+    -------
+    tuple
+        (lat_min, lat_max, lon_min, lon_max) of every region in the shapefiles, the models are padded by one more grid cell when cropped
+    """
+    bounds = np.array([geopandas.read_file(shapefile_dir + shapefile + ".shp").to_crs("epsg:4326").total_bounds for shapefile in shapefile_names])
+    return (float(bounds[:, 1].min()), float(bounds[:, 3].max()), float(bounds[:, 0].min()), float(bounds[:, 2].max()))
+
+def getShapefileSize(shapefile:str) -> int:
+    # Total size of the geometry and attribute files, used to start the most expensive region sets first
+    return sum(os.path.getsize(path) for path in glob.glob(shapefile_dir + glob.escape(shapefile) + ".*"))
+
+def getOutputPaths(metric:str, rcp:str, shapefile:str) -> list:
+    # Every JSON file written for one metric, RCP and shapefile
+    return [output_dir + metric + rcp + shapefile + "_" + product + suffix for product in products for suffix in [".json", "_list.json"]] + [output_dir + shapefile + results_suffix]
+
+def getCodeVersion() -> str:
+    # Hash of every source file that affects the outputs
+    return pmanifest.getCodeVersion([os.path.abspath(__file__), pdata.__file__, rweights.__file__, rresults.__file__, rseries.__file__])
+
+def findStaleOutputs(manifest:dict, force:bool=False, statistics:list=[]) -> tuple:
+    """
+    Parameters
+    ----------
+    manifest : dict
+        manifest from the last run
+    force : bool, optional
+        treat every output as stale. The default is False.
+    statistics : list of str, optional
+        extra region statistics requested, outputs written with different statistics are stale. The default is [].
+    Returns
+    -------
+    tuple
+        (stale, inputs) where stale maps (metric, rcp, shapefile) to the reason it has to be rebuilt and inputs maps
+        the same keys to the current records of their input files
+
+    """
+    code_version = getCodeVersion()
+    # Shapefiles and NetCDF files are shared by many outputs, so each one is only checked once
+    shapefile_records = {shapefile:{'sha256':rweights.hashShapefile(shapefile_dir + shapefile + ".shp")} for shapefile in shapefiles}
+    netcdf_records = {}
+    stale = {}
+    inputs = {}
     for metric in metrics:
         for rcp in rcps:
-            for index, shapefile in enumerate(shapefiles):
-                Process(target=calculate_over_rcp, args=(metric,rcp,shapefile, var_name[index],)).start()
+            for shapefile in shapefiles:
+                entry = manifest['outputs'].get(metric + rcp + shapefile)
+                task_inputs = {}
+                for path in [data_dir + metric + rcp + ".nc", data_dir + metric + rcp + hist_suffix + ".nc"]:
+                    if path not in netcdf_records:
+                        netcdf_records[path] = pmanifest.getFileRecord(path, previous=entry['inputs'].get(path) if entry is not None else None)
+                    task_inputs[path] = netcdf_records[path]
+                task_inputs[shapefile_dir + shapefile + ".shp"] = shapefile_records[shapefile]
+                inputs[(metric, rcp, shapefile)] = task_inputs
+                reason = "forced" if force else pmanifest.getStaleReason(entry, task_inputs, code_version, getOutputPaths(metric, rcp, shapefile))
+                if reason is None and entry.get('statistics', []) != list(statistics):
+                    reason = "statistics changed"
+                if reason is not None:
+                    stale[(metric, rcp, shapefile)] = reason
+                else:
+                    # Keep the refreshed modification times so unchanged files don't get rehashed next run
+                    entry['inputs'] = task_inputs
+    return (stale, inputs)
+
+def main(argv:list=None) -> int:
+    parser = argparse.ArgumentParser(description="Calculate metric averages and model agreement for every region set.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="maximum number of worker processes (default: number of CPUs)")
+    parser.add_argument("--dry-run", action="store_true", help="list the outputs that would be rebuilt and exit")
+    parser.add_argument("--force", action="store_true", help="rebuild every output even if its inputs haven't changed")
+    parser.add_argument("--profile", metavar="DIR", default=None, help="save a cProfile profile of every task to DIR")
+    parser.add_argument("--series", metavar="NETCDF", nargs="+", default=None,
+                        help="instead of the ensemble products, average every time step of these NetCDF files over every region set")
+    parser.add_argument("--stats", metavar="STATISTIC", nargs="*", default=region_statistics,
+                        help="extra area-weighted statistics to write for every region: std, min, max, iqr, p<q> (percentile) or ge<k> (area fraction with agreement of at least k)")
+    args = parser.parse_args(argv)
+    # Reject unknown statistics before anything is calculated
+    for name in args.stats:
+        rweights.parseStatistic(name)
+    
+    if args.series is not None:
+        return runSeries(args.series, args.workers, args.profile)
+    
+    # Only the metric, RCP and shapefile combinations whose inputs or code changed since the last run are recalculated
+    manifest_path = output_dir + manifest_name
+    manifest = pmanifest.loadManifest(manifest_path)
+    stale, inputs = findStaleOutputs(manifest, force=args.force, statistics=args.stats)
+    if args.dry_run:
+        for (metric, rcp, shapefile), reason in stale.items():
+            print("Would rebuild {}{}{} ({})".format(metric, rcp, shapefile, reason))
+        print("{} of {} outputs would be rebuilt".format(len(stale), len(inputs)))
+        return 0
+    if len(stale) == 0:
+        print("All outputs are up to date")
+        pmanifest.saveManifest(manifest_path, manifest)
+        return 0
+    
+    # Stage 1: ensemble products only depend on the metric and RCP, so each pair of NetCDF files is loaded by exactly one task
+    # The models are only read over the area the region sets cover (plus one grid cell)
+    crop_bounds = getShapefileBounds(shapefiles)
+    ensemble_tasks = [(metric + rcp, calculateEnsembleFields, (metric, rcp, crop_bounds)) for metric in metrics for rcp in rcps
+                      if any((metric, rcp, shapefile) in stale for shapefile in shapefiles)]
+    if args.profile is not None:
+        os.makedirs(args.profile, exist_ok=True)
+    ensemble_fields, timings, failures, records = runTasks(ensemble_tasks, args.workers, profile_dir=args.profile)
+    
+    # Stage 2: each shapefile is read and processed once for every stale field, largest region sets are started first
+    shapefile_tasks = []
+    shapefile_outputs = {}
+    for index, shapefile in enumerate(shapefiles):
+        names = [metric + rcp for metric in metrics for rcp in rcps if (metric, rcp, shapefile) in stale and metric + rcp in ensemble_fields]
+        if len(names) > 0:
+            stacked_fields = xr.concat([ensemble_fields[name] for name in names], dim='field')
+            shapefile_tasks.append((shapefile, calculate_over_shapefile, (shapefile, var_name[index], stacked_fields, args.stats)))
+            shapefile_outputs[shapefile] = [(metric, rcp) for metric in metrics for rcp in rcps if metric + rcp in names]
+    shapefile_tasks.sort(key=lambda task: getShapefileSize(task[0]), reverse=True)
+    results, shapefile_timings, shapefile_failures, shapefile_records = runTasks(shapefile_tasks, args.workers, profile_dir=args.profile)
+    timings.update(shapefile_timings)
+    failures.update(shapefile_failures)
+    records.update(shapefile_records)
+    
+    # Record what each successfully rebuilt output was generated from
+    code_version = getCodeVersion()
+    for shapefile, outputs in shapefile_outputs.items():
+        if shapefile in failures:
+            continue
+        for metric, rcp in outputs:
+            manifest['outputs'][metric + rcp + shapefile] = {'inputs':inputs[(metric, rcp, shapefile)], 'code_version':code_version,
+                                                             'outputs':getOutputPaths(metric, rcp, shapefile), 'statistics':list(args.stats)}
+    pmanifest.saveManifest(manifest_path, manifest)
+    
+    print("\nTask wall times:")
+    for name, wall_time in sorted(timings.items(), key=lambda item: np.nan_to_num(item[1]), reverse=True):
+        print("  {:<50} {:>8.1f} s{}".format(name, wall_time, "  FAILED" if name in failures else ""))
+    # Time, CPU and memory of each stage summed over every task, and the regions that took the longest
+    summary = pprofile.summarizeRecords(records)
+    pprofile.printSummary(summary)
+    pprofile.saveReport(output_dir + profile_report_name, summary, records, timings)
+    for name, error in failures.items():
+        print("\nTask " + name + " failed:\n" + error)
+    print("{} of {} tasks failed".format(len(failures), len(timings)))
+    return 1 if len(failures) > 0 else 0
+
+def runSeries(series_paths:list, workers:int, profile_dir:str=None) -> int:
+    # One task per NetCDF file and region set, each streams its series to disk a chunk of time steps at a time
+    os.makedirs(output_dir, exist_ok=True)
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    tasks = [(os.path.basename(path) + shapefile, calculate_series_over_shapefile, (path, shapefile, var_name[index]))
+             for path in series_paths for index, shapefile in enumerate(shapefiles)]
+    results, timings, failures, records = runTasks(tasks, workers, profile_dir=profile_dir)
+    for name, paths in results.items():
+        for path in paths:
+            print("Wrote " + path)
+    pprofile.printSummary(pprofile.summarizeRecords(records))
+    for name, error in failures.items():
+        print("\nTask " + name + " failed:\n" + error)
+    print("{} of {} tasks failed".format(len(failures), len(timings)))
+    return 1 if len(failures) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
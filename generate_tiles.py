@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Builds a vector tile (MVT) pyramid of every region layer for the web app.
+
+Every layer is cut into Web Mercator tiles from min_zoom to max_zoom, simplified for each zoom level,
+and stored gzipped in a single SQLite file using the MBTiles tile layout (TMS row order) with an
+extra 'layer' column, so the map only downloads the tiles it is displaying. Each feature's id is
+its region index, so metric values can be joined to it (Mapbox feature state), or baked in as
+properties from the region results files.
+"""
+import geopandas
+import mapbox_vector_tile
+import numpy
+import shapely
+import sqlite3
+import argparse
+import hashlib
+import gzip
+import json
+import os
+import region_results as rresults
+
+shapefile_dir = "shapefiles/"
+# Same directory the web app reads the region results from (webapp.data_dir)
+results_dir = "data/json_data/"
+results_suffix = "_results.npz"
+tiles_path = "region_tiles.mbtiles"
+shapefiles = ["CA_Counties_TIGER2016", "CA_Places_TIGER2016", "CA_Bulletin_118_Groundwater_Basins", "WBD_USGS_HUC10_CA"]
+var_name = ["NAME", "NAME", "Basin_Su_1", "Name"]
+
+min_zoom = 4
+max_zoom = 12
+# Resolution of the tile coordinates, and how far (in tile units) geometry extends past the tile edge so borders don't show seams
+tile_extent = 4096
+tile_buffer = 64
+# Half the width of the Web Mercator world in meters
+mercator_half_width = 20037508.342789244
+
+def getTileBounds(zoom:int, x:int, y:int) -> tuple:
+    """
+    Parameters
+    ----------
+    zoom : int
+        zoom level
+    x : int
+        tile column
+    y : int
+        tile row, counted from the top (XYZ scheme, as requested by the map)
+
+    Returns
+    -------
+    tuple
+        (min_x, min_y, max_x, max_y) of the tile in Web Mercator meters
+    """
+    size = 2 * mercator_half_width / 2 ** zoom
+    return (-mercator_half_width + x * size, mercator_half_width - (y + 1) * size, -mercator_half_width + (x + 1) * size, mercator_half_width - y * size)
+
+def getTileRange(bounds:tuple, zoom:int) -> tuple:
+    """
+    Parameters
+    ----------
+    bounds : tuple
+        (min_x, min_y, max_x, max_y) in Web Mercator meters
+    zoom : int
+        zoom level
+
+    Returns
+    -------
+    tuple
+        (ranges of tile columns, range of tile rows) covering the bounds
+    """
+    size = 2 * mercator_half_width / 2 ** zoom
+    last = 2 ** zoom - 1
+    x_min = min(max(int((bounds[0] + mercator_half_width) // size), 0), last)
+    x_max = min(max(int((bounds[2] + mercator_half_width) // size), 0), last)
+    y_min = min(max(int((mercator_half_width - bounds[3]) // size), 0), last)
+    y_max = min(max(int((mercator_half_width - bounds[1]) // size), 0), last)
+    return (range(x_min, x_max + 1), range(y_min, y_max + 1))
+
+def openTileDatabase(path:str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path)
+    # The ETag of each tile is stored next to it, so the web app doesn't have to decompress and hash the tile on every request
+    connection.execute("CREATE TABLE IF NOT EXISTS tiles (layer TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB, "
+                       "tile_etag TEXT, PRIMARY KEY (layer, zoom_level, tile_column, tile_row))")
+    connection.execute("CREATE TABLE IF NOT EXISTS metadata (layer TEXT, name TEXT, value TEXT, PRIMARY KEY (layer, name))")
+    return connection
+
+def getFeatureProperties(shapefile:str, names:numpy.ndarray) -> list:
+    """
+    Parameters
+    ----------
+    shapefile : str
+        name of the region set
+    names : numpy.ndarray
+        name of each region
+
+    Returns
+    -------
+    list of dict
+        properties of each feature: 'index', 'NAME' and the value of every field in the region results file
+    """
+    properties = [{'index':index, 'NAME':str(name)} for index, name in enumerate(names)]
+    path = results_dir + shapefile + results_suffix
+    # Tiles built without the values they were asked for would look fine until the map tries to color them
+    if not os.path.isfile(path):
+        raise FileNotFoundError("No region results file for " + shapefile + " at " + path + ", run generate_region_data.py first")
+    results = rresults.loadRegionResults(path)
+    if len(results['NAME']) != len(names):
+        raise ValueError("{} has {} regions but the shapefile has {}, regenerate the region results".format(path, len(results['NAME']), len(names)))
+    for column, field in enumerate(results['fields'].tolist()):
+        for row, value in enumerate(results['values'][:, column].tolist()):
+            properties[row][field] = value
+    return properties
+
+def getPolygonalGeometries(geometries:numpy.ndarray) -> numpy.ndarray:
+    """
+    Parameters
+    ----------
+    geometries : numpy.ndarray
+        array of shapely geometries, for example repaired with make_valid or clipped to a tile
+
+    Returns
+    -------
+    numpy.ndarray
+        the same geometries with every geometry collection reduced to its polygons (MVT can't encode collections, and lines
+        or points left over from repairing a region aren't part of its area)
+    """
+    geometries = numpy.array(geometries, dtype=object)
+    for index in numpy.flatnonzero(shapely.get_type_id(geometries) == shapely.GeometryType.GEOMETRYCOLLECTION):
+        parts = shapely.get_parts(geometries[index])
+        polygons = parts[numpy.isin(shapely.get_type_id(parts), [shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])]
+        geometries[index] = shapely.union_all(polygons) if len(polygons) > 0 else shapely.Polygon()
+    return geometries
+
+def generateLayerTiles(connection:sqlite3.Connection, shapefile:str, s_var_name:str, with_values:bool=False) -> int:
+    """
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        tile database to write to, any existing tiles for this layer are replaced
+    shapefile : str
+        name of shapefile in shapefile_dir, also used as the layer name
+    s_var_name : str
+        name of variable in the shapefile labeling each region
+    with_values : bool, optional
+        store every metric value from the region results file as a feature property (otherwise only 'index' and 'NAME'),
+        raises FileNotFoundError if the region set has no results file. The default is False.
+
+    Returns
+    -------
+    int
+        number of tiles written
+    """
+    regions = geopandas.read_file(shapefile_dir + shapefile + ".shp").to_crs("epsg:3857")
+    geometries = getPolygonalGeometries(shapely.make_valid(regions.geometry.values))
+    if with_values:
+        properties = getFeatureProperties(shapefile, regions[s_var_name].values)
+    else:
+        properties = [{'index':index, 'NAME':str(name)} for index, name in enumerate(regions[s_var_name].values)]
+
+    count = 0
+    with connection:
+        connection.execute("DELETE FROM tiles WHERE layer = ?", (shapefile,))
+        for zoom in range(min_zoom, max_zoom + 1):
+            # Detail smaller than one tile unit can't be displayed, so simplify every region once per zoom level
+            tile_unit = 2 * mercator_half_width / 2 ** zoom / tile_extent
+            simplified = shapely.simplify(geometries, tile_unit, preserve_topology=True)
+            tree = shapely.STRtree(simplified)
+            x_range, y_range = getTileRange(tuple(regions.total_bounds), zoom)
+            for x in x_range:
+                for y in y_range:
+                    min_x, min_y, max_x, max_y = getTileBounds(zoom, x, y)
+                    buffer = tile_buffer * tile_unit
+                    indices = tree.query(shapely.box(min_x - buffer, min_y - buffer, max_x + buffer, max_y + buffer))
+                    if len(indices) == 0:
+                        continue
+                    clipped = getPolygonalGeometries(shapely.clip_by_rect(simplified[indices], min_x - buffer, min_y - buffer, max_x + buffer, max_y + buffer))
+                    features = [{'geometry':geometry, 'properties':properties[index], 'id':int(index)}
+                                for index, geometry in zip(indices, clipped) if geometry is not None and not shapely.is_empty(geometry)]
+                    if len(features) == 0:
+                        continue
+                    tile = mapbox_vector_tile.encode([{'name':shapefile, 'features':features}],
+                                                     default_options={'quantize_bounds':(min_x, min_y, max_x, max_y), 'extents':tile_extent})
+                    # MBTiles stores rows bottom to top (TMS) and tiles gzipped, the ETag is the same hash of the tile the web app uses for every response
+                    connection.execute("INSERT INTO tiles (layer, zoom_level, tile_column, tile_row, tile_data, tile_etag) VALUES (?, ?, ?, ?, ?, ?)",
+                                       (shapefile, zoom, x, 2 ** zoom - 1 - y, gzip.compress(tile, mtime=0), hashlib.sha256(tile).hexdigest()[:32]))
+                    count += 1
+            print("{} zoom {}: {} tiles in total".format(shapefile, zoom, count))
+
+        lon_lat_bounds = regions.to_crs("epsg:4326").total_bounds.tolist()
+        metadata = {'name':shapefile, 'format':'pbf', 'minzoom':str(min_zoom), 'maxzoom':str(max_zoom), 'bounds':",".join(str(value) for value in lon_lat_bounds),
+                    'json':json.dumps({'vector_layers':[{'id':shapefile, 'fields':{name:"Number" if name != 'NAME' else "String" for name in properties[0]}}]})}
+        connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)", [(shapefile, name, value) for name, value in metadata.items()])
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the vector tile pyramid of every region layer.")
+    parser.add_argument("shapefiles", nargs="*", default=shapefiles, help="shapefiles to process (default: every region set)")
+    parser.add_argument("--with-values", action="store_true", help="store every metric value from the region results files as a feature property")
+    args = parser.parse_args()
+    connection = openTileDatabase(tiles_path)
+    for shapefile in args.shapefiles:
+        generateLayerTiles(connection, shapefile, var_name[shapefiles.index(shapefile)], with_values=args.with_values)
+    connection.execute("VACUUM")
+    connection.close()
@@ -6,18 +6,29 @@ Created on Fri Apr  9 12:26:01 2021
 """
 import redis
 import json
-from os import listdir
-from os.path import isfile, join
 import uuid
+import sys
+import os
 
-data_dir = "json_data/"
+# region_results.py is at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import region_results as rresults
 
-print("Connecting to database...")
-rd = redis.StrictRedis(host="127.0.0.1", port="6379", db=0, decode_responses=True)
-print("Connected. Flushing...")
-rd.flushdb()
+# Directory holding the region results files written by generate_region_data.py, "<region set>_results.npz"
+data_dir = "json_data/"
+results_suffix = "_results.npz"
 
-datasets = [f for f in listdir(data_dir) if isfile(join(data_dir, f))]
+# Key holding the prefix of the dataset currently being served, the web app reads "<prefix>:<key>"
+alias_key = "dataset:current"
+# Channel the web app listens on to clear its cache after a reload
+reload_channel = "dataset:reload"
+# Number of keys written per round-trip to the database
+batch_size = 256
+# Seconds the replaced dataset is kept after the switch, well past the web app's DATA_VERSION_CHECK_INTERVAL (5 s),
+# so workers that have not yet seen the new alias can finish reading the old keys
+previous_version_grace = 60
+# Hash of every value for one region, "<prefix>:region:<region set>:<region name>" with fields "<metric>_<rcp>_<data type>"
+region_key_format = "{}:region:{}:{}"
 
 # List of RCP models to use
 rcps = ["RCP85", "RCP45"]
@@ -30,15 +41,97 @@ data_types = ["totalagreement", "totalaverage"]
 
 region_sets = ["CA_Counties_TIGER2016", "CA_Places_TIGER2016", "CA_Bulletin_118_Groundwater_Basins", "WBD_USGS_HUC10_CA"]
 
-for region_set in region_sets:
-    key_pair = {}
-    # et_RCP45CA_Bulletin_118_Groundwater_Basins_totaleaverage
+def getDatasetFields():
+    # (metric, rcp, region set, data type) of each dataset, in the same order as getDatasetFiles
     for metric in metrics:
         for rcp in rcps:
             for region_set in region_sets:
                 for data_type in data_types:
-                    with open(data_dir + "{}_{}{}_{}.json".format(metric, rcp, region_set, data_type), 'r') as f:
-                        rd.set("{}_{}_{}_{}".format(metric, rcp, region_set, data_type), json.dumps(json.load(f)))
+                    yield (metric, rcp, region_set, data_type)
+
+def getDatasetKeys():
+    # For example et_RCP45_CA_Bulletin_118_Groundwater_Basins_totalaverage, in the same order as getDatasetFields
+    for metric, rcp, region_set, data_type in getDatasetFields():
+        yield "{}_{}_{}_{}".format(metric, rcp, region_set, data_type)
+
+def addRegionFields(region_hashes:dict, version:str, metric:str, rcp:str, region_set:str, data_type:str, regions:list) -> None:
+    # Spread one dataset (a list of regions) over the per-region hashes, so a single region can be read without the whole list
+    field = "{}_{}_{}".format(metric, rcp, data_type)
+    for region in regions:
+        key = region_key_format.format(version, region_set, region["NAME"])
+        if key not in region_hashes:
+            region_hashes[key] = {"index":region["index"], "valid":int(region["valid"])}
+        # If a name is used by more than one region, the first one is kept (the same region the web app finds by name)
+        elif region_hashes[key]["index"] != region["index"]:
+            continue
+        region_hashes[key][field] = json.dumps(region["value"])
+
+def runOnKeys(rd, keys, command:str, *args) -> int:
+    # Run a command on every key in batches, for example "unlink" or "expire" with the seconds, returns the number of keys
+    pipe = rd.pipeline(transaction=False)
+    count = 0
+    for key in keys:
+        getattr(pipe, command)(key, *args)
+        count += 1
+        if len(pipe) >= batch_size:
+            pipe.execute()
+    pipe.execute()
+    return count
+
+def loadDataset(rd) -> str:
+    """
+    Writes every dataset under a new versioned prefix and then switches the alias to it, so the web app keeps
+    serving the previous complete dataset until the new one is fully loaded.
+
+    Returns
+    -------
+    str
+        prefix of the newly loaded dataset
+    """
+    version = "dataset:" + uuid.uuid4().hex
+    pipe = rd.pipeline(transaction=False)
+    count = 0
+    region_hashes = {}
+    # Every dataset of a region set is a column of its results file, which is memory-mapped so only the columns used are read
+    region_results = {region_set:rresults.loadRegionResults(data_dir + region_set + results_suffix, mmap=True) for region_set in region_sets}
+    for key, (metric, rcp, region_set, data_type) in zip(getDatasetKeys(), getDatasetFields()):
+        results = region_results[region_set]
+        field = "{}_{}_{}".format(metric, rcp, data_type)
+        if field not in results['columns']:
+            raise KeyError(field + " not found in " + data_dir + region_set + results_suffix)
+        regions = rresults.getColumnRegions(results, results['columns'][field])
+        pipe.set(version + ":" + key, json.dumps(regions, allow_nan=False))
+        addRegionFields(region_hashes, version, metric, rcp, region_set, data_type, regions)
+        count += 1
+        # One round-trip per batch instead of one per key
+        if len(pipe) >= batch_size:
+            pipe.execute()
+    for key, fields in region_hashes.items():
+        pipe.hset(key, mapping=fields)
+        if len(pipe) >= batch_size:
+            pipe.execute()
+    pipe.execute()
+    print("Staged {} keys and {} region hashes under {}".format(count, len(region_hashes), version))
+    
+    # Atomically point the web app at the new dataset, then let the one it replaces expire (rather than removing it while it may
+    # still be read) once every worker has moved on
+    previous = rd.getset(alias_key, version)
+    print("Switched " + alias_key + " to " + version)
+    rd.publish(reload_channel, version)
+    if previous is not None:
+        count = runOnKeys(rd, rd.scan_iter(match=previous + ":*", count=1000), "expire", previous_version_grace)
+        print("Expiring {} keys from {} in {} s".format(count, previous, previous_version_grace))
+    else:
+        # Keys written by the old loader (without a version prefix) are no longer read once the alias exists
+        count = runOnKeys(rd, getDatasetKeys(), "expire", previous_version_grace)
+        print("Expiring {} unversioned keys in {} s".format(count, previous_version_grace))
+    return version
+
+if __name__ == "__main__":
+    print("Connecting to database...")
+    rd = redis.StrictRedis(host="127.0.0.1", port="6379", db=0, decode_responses=True)
+    print("Connected. Loading...")
+    loadDataset(rd)
 
 
 # for file_name in datasets:
@@ -38,7 +38,7 @@ def cropRegionLatLon(array:xarray.DataArray, lat_min:int, lat_max:int, lon_min:i
     lon_mask = (array.lon >= lon_min) & (array.lon <= lon_max)
     return array.where(lat_mask & lon_mask, drop=True)
 
-def getModelsFromNetCDF(path:str, names:list=['']) -> list:
+def getModelsFromNetCDF(path:str, names:list=[''], chunks:dict=None, exact:bool=False, bounds:tuple=None, unique:bool=False) -> list:
     """
     Parameters
     ----------
@@ -46,31 +46,151 @@ def getModelsFromNetCDF(path:str, names:list=['']) -> list:
         path to netCDF to extract models from
     names : list of strings, optional
         list of names of models to extract, by default all found will be extracted. The default is [''].
+    chunks : dict, optional
+        dask chunk sizes to open the file with (for example {} or {'lat': 100, 'lon': 100}). If specified, the models are
+        returned as lazy dask arrays and only the bytes that are used get read, the file stays open until the models are
+        released. Otherwise the selected models are read into memory and the file is closed. The default is None.
+    exact : bool, optional
+        only select variables whose name is exactly one of 'names', otherwise any variable containing one of the
+        names is selected (each variable at most once). The default is False.
+    bounds : tuple, optional
+        (lat_min, lat_max, lon_min, lon_max) to crop the models to before anything is read (see CALIFORNIA_BOUNDS).
+        Bounds are padded by one grid cell so cells that only touch the boundary are kept. The default is None.
+    unique : bool, optional
+        require every name to select exactly one variable, so the i-th model is always the model named names[i] and
+        models from different files can be paired by position. The default is False.
 
     Returns
     -------
     models : list of data arrays
-        list of models
+        list of models, in the same order as 'names'
     """
-    # Open metric dataset
-    dataset = xarray.open_dataset(path)
-    models = []
+    # Open metric dataset (lazily, nothing is read until the values are used)
+    dataset = xarray.open_dataset(path, chunks=chunks)
+    
+    # Resolve the variables to load up front, in the order of the names given so models from different files line up
+    try:
+        selected = getModelVariables(dataset, names, exact, path, unique)
+    except KeyError:
+        dataset.close()
+        raise
+    dataset = dataset[selected]
     
-    # Cycle through models in dataset, adding each one to a list
-    for model in dataset:
-        # Cycle through names and if a model name is found, add it to the list
-        for name in names:
-            if (name in model):
-                models.append(dataset[model])
+    if bounds is not None:
+        dataset = cropRegionLatLon(dataset, *getPaddedBounds(dataset, bounds))
     
-    return models
+    if chunks is None:
+        # Read only the selected (and cropped) models, then release the file
+        dataset = dataset.load()
+        dataset.close()
+    return [dataset[variable] for variable in selected]
+
+def getModelVariables(dataset:xarray.Dataset, names:list, exact:bool, path:str, unique:bool=False) -> list:
+    """
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        opened netCDF to select models from
+    names : list of strings
+        names of the models to select, see getModelsFromNetCDF
+    exact : bool
+        only select variables whose name is exactly one of 'names'
+    path : string
+        path of the netCDF, for the error message
+    unique : bool, optional
+        raise a KeyError unless every name selects exactly one variable. The default is False.
+
+    Returns
+    -------
+    selected : list of strings
+        variables to load, in the order of 'names'
+    """
+    variables = list(dataset.data_vars)
+    if exact:
+        missing = [name for name in names if name not in variables]
+        if len(missing) > 0:
+            raise KeyError("Models " + str(missing) + " not found in " + path)
+        return list(names)
+    if unique:
+        # One variable per name, so a model missing from (or ambiguous in) one file can't shift the pairing with another file
+        matches = {name:[variable for variable in variables if name in variable] for name in names}
+        wrong = {name:found for name, found in matches.items() if len(found) != 1}
+        if len(wrong) > 0:
+            raise KeyError("Models " + str(wrong) + " do not match exactly one variable in " + path)
+        return [matches[name][0] for name in names]
+    selected = []
+    for name in names:
+        for variable in variables:
+            if name in variable and variable not in selected:
+                selected.append(variable)
+    return selected
+
+def iterModelsFromNetCDF(path:str, names:list=[''], exact:bool=False, bounds:tuple=None, dtype:type=None, unique:bool=False):
+    """
+    Parameters
+    ----------
+    path : string
+        path to netCDF to extract models from
+    names : list of strings, optional
+        list of names of models to extract, see getModelsFromNetCDF. The default is [''].
+    exact : bool, optional
+        only select variables whose name is exactly one of 'names'. The default is False.
+    bounds : tuple, optional
+        (lat_min, lat_max, lon_min, lon_max) to crop each model to, see getModelsFromNetCDF. The default is None.
+    dtype : type, optional
+        type to convert each model to (for example numpy.float32 to halve the memory used), kept as stored if not specified. The default is None.
+    unique : bool, optional
+        require every name to select exactly one variable, see getModelsFromNetCDF. The default is False.
+
+    Yields
+    ------
+    model : data array
+        each model in the same order as 'names', read only when it is reached so just one model needs to be in memory at a time
+    """
+    # Nothing is read until a variable's values are used, and without the cache a variable isn't kept by the dataset once read
+    with xarray.open_dataset(path, cache=False) as dataset:
+        selected = getModelVariables(dataset, names, exact, path, unique)
+        padded_bounds = getPaddedBounds(dataset, bounds) if bounds is not None else None
+        for variable in selected:
+            model = dataset[variable]
+            if padded_bounds is not None:
+                model = cropRegionLatLon(model, *padded_bounds)
+            # compute() returns a loaded copy, load() would also keep the values in the dataset
+            model = model.compute()
+            yield model if dtype is None else model.astype(dtype, copy=False)
+
+# Rough bounding box (lat_min, lat_max, lon_min, lon_max) around California. Some region sets reach beyond it (the HUC10 watersheds
+# extend into Mexico and Arizona), so the pipeline crops to the bounds of its shapefiles instead (generate_region_data.getShapefileBounds)
+CALIFORNIA_BOUNDS = (32, 43, -125, -114)
+
+def getPaddedBounds(array:xarray.Dataset, bounds:tuple) -> tuple:
+    """
+    Parameters
+    ----------
+    array : xarray.Dataset or xarray.DataArray
+        data with lat and lon coordinates that will be cropped
+    bounds : tuple
+        (lat_min, lat_max, lon_min, lon_max) with longitudes from -180 to 180
+
+    Returns
+    -------
+    tuple
+        bounds padded by one grid cell, with longitudes converted to 0 to 360 if the data uses that convention
+    """
+    lat_min, lat_max, lon_min, lon_max = bounds
+    lat_pad = abs((array.lat[1] - array.lat[0]).item()) if array.lat.size > 1 else 0
+    lon_pad = abs((array.lon[1] - array.lon[0]).item()) if array.lon.size > 1 else 0
+    if array.lon.max().item() > 180 and lon_min < 0:
+        lon_min += 360
+        lon_max += 360
+    return (lat_min - lat_pad, lat_max + lat_pad, lon_min - lon_pad, lon_max + lon_pad)
 
 
 def getMeanModel(models:xarray.DataArray) -> xarray.DataArray:
     """
     Parameters
     ----------
-    models : list of data arrays
+    models : list (or generator) of data arrays
         Models to average
         
     Returns
@@ -78,14 +198,18 @@ def getMeanModel(models:xarray.DataArray) -> xarray.DataArray:
     mean_model : data array
         Average model of the same structure
     """
-    # Create empty structure to sum all of the models over
-    models_sum = models[0] * 0
+    models = iter(models)
+    # Start the sum from a float copy of the first model and add the rest in place, so no new array is allocated per model
+    # (integer models, such as event counts, still get a float mean)
+    models_sum = next(models).astype(float)
+    count = 1
     for model in models:
-        models_sum = models_sum + model
+        models_sum += model
+        count += 1
     
     # Divide the sum by the number of models to get hte size
-    mean_model = models_sum / len(models)
-    return mean_model
+    models_sum /= count
+    return models_sum
 
 def getModelsAgreement(mean_model:xarray.DataArray(), models:list) -> xarray.DataArray:
     """
@@ -93,7 +217,7 @@ def getModelsAgreement(mean_model:xarray.DataArray(), models:list) -> xarray.Dat
     ----------
     mean_model : data array
         The average of all the models, what each model will be compared to
-    models : list of data arrays
+    models : list (or generator) of data arrays
         list of models to compare against the mean_model
 
     Returns
@@ -104,27 +228,140 @@ def getModelsAgreement(mean_model:xarray.DataArray(), models:list) -> xarray.Dat
     """
     # To keep track of how many models agree for each point, create empty array preserving structure
     model_agreement = mean_model * 0
+    # Indicating a positive value in the larger, mean model (the same for every model, so only calculated once)
+    mean_pos = (mean_model > 0)
+    # Indiciating a negative value in the larger, mean model
+    mean_neg = (mean_model < 0)
     
     for model in models:
-        # Indicating a positive value in the larger, mean model
-        mean_pos = (mean_model > 0)
-        # Indiciating a negative value in the larger, mean model
-        mean_neg = (mean_model < 0)
-        # Indiciating a positive value in the individual model in question
-        model_pos = (model > 0)
-        # Indiciating a negative value in the individual model in question
-        model_neg = (model < 0)
-        # Count where this model if it agrees with the mean model over the structure of the array (adds 1 to model_agreement')
-        agree = model * 0 + 1
-        # Don't count it if it disagrees (adds 0 to 'model_agreement')
-        disagree = model * 0
         # The individual model and mean model agree where both are positive in change or both are negative in change
-        models_agree = numpy.logical_or(numpy.logical_and(model_pos, mean_pos),numpy.logical_and(model_neg, mean_neg))
-        # The agreement array has the same structure as the models, but only keeps count of how many models agree for each point
-        model_agreement = model_agreement + xarray.where(models_agree, agree, disagree)
+        models_agree = numpy.logical_or(numpy.logical_and(model > 0, mean_pos), numpy.logical_and(model < 0, mean_neg))
+        # The agreement array has the same structure as the models, but only keeps count of how many models agree for each point (NaN where the model is NaN)
+        model_agreement += models_agree.where(model.notnull())
         
     return model_agreement
 
+def getEnsembleStatistics(models:list, percentiles:list=None) -> xarray.Dataset:
+    """
+    Calculates the ensemble mean, sign agreement, spread and range in a single pass over the models
+    
+    Parameters
+    ----------
+    models : list (or generator) of data arrays
+        models to calculate statistics over, a generator lets each model be loaded, used and released one at a time
+    percentiles : list of floats, optional
+        percentiles (0 - 100) to calculate across the models. These need every model at once, so the models are
+        only kept in memory (stacked along a 'model' dimension) when percentiles are requested. The default is None.
+
+    Returns
+    -------
+    statistics : xarray.Dataset
+        dataset with the same structure as the models containing 'mean', 'agreement' (number of models that agree with the
+        sign of the mean, same as getModelsAgreement), 'std' (spread across models), 'min', 'max' and 'percentiles' (along a 'percentile' dimension) if requested
+    """
+    count = 0
+    kept_models = []
+    for model in models:
+        values = numpy.asarray(model.values, dtype=float)
+        if count == 0:
+            # Keep only the structure of the first model, not its data
+            dims = model.dims
+            coords = model.coords
+            models_sum = values.copy()
+            running_mean = values.copy()
+            running_m2 = numpy.zeros_like(values)
+            models_min = values.copy()
+            models_max = values.copy()
+            positive = (values > 0).astype(numpy.int16)
+            negative = (values < 0).astype(numpy.int16)
+            delta = numpy.empty_like(values)
+        else:
+            numpy.add(models_sum, values, out=models_sum)
+            numpy.minimum(models_min, values, out=models_min)
+            numpy.maximum(models_max, values, out=models_max)
+            positive += (values > 0)
+            negative += (values < 0)
+            # Welford's update of the running mean and sum of squared differences for the spread
+            numpy.subtract(values, running_mean, out=delta)
+            running_mean += delta / (count + 1)
+            running_m2 += delta * (values - running_mean)
+        count += 1
+        if percentiles is not None:
+            kept_models.append(values)
+    
+    mean = models_sum / count
+    # Count of models agreeing with the sign of the mean, NaN wherever the mean is NaN (just like getModelsAgreement)
+    agreement = numpy.where(mean > 0, positive, numpy.where(mean < 0, negative, 0)).astype(float)
+    agreement[numpy.isnan(mean)] = numpy.nan
+    
+    statistics = xarray.Dataset({'mean':(dims, mean), 'agreement':(dims, agreement), 'std':(dims, numpy.sqrt(running_m2 / count)),
+                                 'min':(dims, models_min), 'max':(dims, models_max)}, coords=coords)
+    if percentiles is not None:
+        statistics['percentiles'] = (('percentile',) + dims, numpy.percentile(numpy.stack(kept_models), percentiles, axis=0))
+        statistics = statistics.assign_coords(percentile=list(percentiles))
+    statistics.attrs['model_count'] = count
+    return statistics
+
+def getRelativeRatioEnsemble(perc_models:list, perc_historical_models:list, dtype:type=float, min_historical:float=None) -> xarray.Dataset:
+    """
+    Calculates the same mean as getMeanModel(getRelativeRatioModels(...)) and the same agreement as getEnsembleStatistics(perc_models)
+    in one pass, keeping only one pair of models and a few running sums in memory at a time
+    
+    Parameters
+    ----------
+    perc_models : list (or generator) of data arrays
+        projection models, a generator (such as iterModelsFromNetCDF) lets each model be read, used and released one at a time
+    perc_historical_models : list (or generator) of data arrays
+        historical models to compare 'perc_models' to index by index, so both must list the same models in the same order
+        (for example selected with unique=True). A ValueError is raised if one runs out before the other.
+    dtype : type, optional
+        type of the running sums and the ratio, numpy.float32 halves the memory used. The default is float.
+    min_historical : float, optional
+        historical values at or below this are treated as missing (for example to ignore cells with almost no snow). The default is None.
+
+    Returns
+    -------
+    statistics : xarray.Dataset
+        dataset with the same structure as the models containing 'mean' (average relative ratio, in percent) and 'agreement'
+        (number of projection models that agree with the sign of their mean)
+    """
+    count = 0
+    for model, hist_model in zip(perc_models, perc_historical_models, strict=True):
+        values = numpy.asarray(model.values, dtype=dtype)
+        hist = numpy.asarray(hist_model.values, dtype=dtype)
+        if count == 0:
+            # Keep only the structure of the first model, not its data
+            dims = model.dims
+            coords = model.coords
+            models_sum = numpy.zeros_like(values)
+            ratio_sum = numpy.zeros_like(values)
+            ratio = numpy.empty_like(values)
+            positive = numpy.zeros(values.shape, dtype=numpy.int16)
+            negative = numpy.zeros(values.shape, dtype=numpy.int16)
+        models_sum += values
+        positive += (values > 0)
+        negative += (values < 0)
+        # Ratio of this model to its historical model, in percent, computed in one reused buffer
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            numpy.divide(values, hist, out=ratio)
+        ratio *= 100
+        ratio[hist == 0] = numpy.nan
+        if min_historical is not None:
+            ratio[hist <= min_historical] = numpy.nan
+        ratio_sum += ratio
+        count += 1
+        # Release this pair before the next one is read
+        del model, hist_model, values, hist
+    
+    mean = models_sum / count
+    # Same as getEnsembleStatistics, NaN wherever the mean is NaN
+    agreement = numpy.where(mean > 0, positive, numpy.where(mean < 0, negative, 0)).astype(dtype)
+    agreement[numpy.isnan(mean)] = numpy.nan
+    ratio_sum /= count
+    statistics = xarray.Dataset({'mean':(dims, ratio_sum), 'agreement':(dims, agreement)}, coords=coords)
+    statistics.attrs['model_count'] = count
+    return statistics
+
 def getPercentChangeModels(perc_models:list, perc_historical_models:list) -> list:
     """
     Parameters
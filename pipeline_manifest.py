@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Run manifest for the region data pipeline.
+
+Records the inputs (NetCDF modification times and hashes, shapefile hashes) and code version that
+each output was generated from, so a rerun only recomputes the outputs whose inputs have changed.
+"""
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+def hashFile(path:str) -> str:
+    """
+    Parameters
+    ----------
+    path : str
+        path to file to hash
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def getFileRecord(path:str, previous:dict=None) -> dict:
+    """
+    Parameters
+    ----------
+    path : str
+        path to input file
+    previous : dict, optional
+        record of the same file from the last run, its hash is reused if the size and modification time match. The default is None.
+
+    Returns
+    -------
+    dict
+        'mtime', 'size' and 'sha256' of the file, or 'missing' if the file doesn't exist
+    """
+    if not os.path.isfile(path):
+        return {'missing':True}
+    stat = os.stat(path)
+    record = {'mtime':stat.st_mtime, 'size':stat.st_size}
+    # Hashing large NetCDF files is slow, so only rehash when the file looks like it has been modified
+    if previous is not None and previous.get('mtime') == record['mtime'] and previous.get('size') == record['size'] and 'sha256' in previous:
+        record['sha256'] = previous['sha256']
+    else:
+        record['sha256'] = hashFile(path)
+    return record
+
+def getCodeVersion(paths:list) -> str:
+    """
+    Parameters
+    ----------
+    paths : list of str
+        source files the outputs are generated with
+
+    Returns
+    -------
+    str
+        hash of the source files, changes whenever the code producing the outputs changes
+    """
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode())
+        digest.update(hashFile(path).encode())
+    return digest.hexdigest()
+
+def loadManifest(path:str) -> dict:
+    """
+    Parameters
+    ----------
+    path : str
+        path to manifest JSON file
+
+    Returns
+    -------
+    dict
+        the manifest, or an empty manifest if the file doesn't exist or was written by an incompatible version
+    """
+    empty = {'version':MANIFEST_VERSION, 'outputs':{}}
+    if not os.path.isfile(path):
+        return empty
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return empty
+    return manifest
+
+def saveManifest(path:str, manifest:dict) -> None:
+    """
+    Parameters
+    ----------
+    path : str
+        path to manifest JSON file
+    manifest : dict
+        manifest to save
+
+    Returns
+    -------
+    None
+    """
+    # Write to a temporary file first so an interrupted run never leaves a corrupt manifest
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+def getStaleReason(entry:dict, inputs:dict, code_version:str, outputs:list) -> str:
+    """
+    Parameters
+    ----------
+    entry : dict
+        manifest entry for this output from the last run, or None if it has never been generated
+    inputs : dict
+        current records of every input, keyed by path
+    code_version : str
+        current code version
+    outputs : list of str
+        paths of the output files
+
+    Returns
+    -------
+    str
+        why the output has to be rebuilt, or None if it is up to date
+    """
+    if entry is None:
+        return "not in manifest"
+    missing_outputs = [path for path in outputs if not os.path.isfile(path)]
+    if len(missing_outputs) > 0:
+        return "missing output " + os.path.basename(missing_outputs[0])
+    if entry.get('code_version') != code_version:
+        return "code changed"
+    for path, record in inputs.items():
+        if record.get('missing', False):
+            return "missing input " + path
+        if entry['inputs'].get(path, {}).get('sha256') != record['sha256']:
+            return "input changed " + path
+    return None
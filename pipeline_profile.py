@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation for the region data pipeline.
+
+Each process keeps a list of stage records (wall time, CPU time and memory of stages such as
+loading the NetCDF files or writing the JSON files) and per-region records. Worker processes hand
+their records back with each task's result, and the main process combines the records of every
+task into one summary report.
+"""
+import contextlib
+import resource
+import json
+import time
+import sys
+
+# Records of the current process since the last call to takeRecords
+stage_records = []
+region_records = []
+# Stages currently running in this process (outermost first), each with the highest peak seen before an inner stage reset it
+open_stages = []
+
+def readMemoryStatus(field:str) -> float:
+    """
+    Parameters
+    ----------
+    field : str
+        memory field of /proc/self/status, for example "VmRSS" (current) or "VmHWM" (peak since the last reset)
+
+    Returns
+    -------
+    float
+        value of the field in MB, or None where /proc isn't available (macOS)
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def getLifetimePeakMemory() -> float:
+    # Peak resident set size since the process started, Linux reports kilobytes and macOS reports bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def resetPeakMemory() -> bool:
+    # Writing 5 to clear_refs resets the peak (VmHWM) to the current resident set size (Linux 4.0 and later)
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def getCurrentMemory() -> float:
+    """
+    Returns
+    -------
+    float
+        resident set size of this process right now, in MB (the lifetime peak where it can't be read)
+    """
+    current = readMemoryStatus("VmRSS")
+    return getLifetimePeakMemory() if current is None else current
+
+def getPeakMemory() -> float:
+    """
+    Returns
+    -------
+    float
+        peak resident set size of this process since the last resetPeakMemory (or since it started), in MB
+    """
+    peak = readMemoryStatus("VmHWM")
+    return getLifetimePeakMemory() if peak is None else peak
+
+def startStage() -> dict:
+    # The peak reached so far belongs to the stages already running, it is kept for them before the peak is reset for the new stage
+    peak = getPeakMemory()
+    for running in open_stages:
+        running['peak'] = max(running['peak'], peak)
+    start = {'wall':time.perf_counter(), 'cpu':time.process_time(), 'rss':getCurrentMemory(), 'peak':0.0, 'reset':resetPeakMemory()}
+    open_stages.append(start)
+    return start
+
+def endStage(start:dict, name:str, labels:dict, record:bool=True) -> None:
+    open_stages.remove(start)
+    if not record:
+        return
+    # Worker processes are reused across tasks, so without a reset the peak is the largest of any stage the worker ran before
+    stage_records.append({'stage':name, 'wall':time.perf_counter() - start['wall'], 'cpu':time.process_time() - start['cpu'],
+                          'peak_rss_mb':max(start['peak'], getPeakMemory()), 'peak_is_per_stage':start['reset'],
+                          'start_rss_mb':start['rss'], 'end_rss_mb':getCurrentMemory(), **labels})
+
+@contextlib.contextmanager
+def stage(name:str, **labels):
+    """
+    Parameters
+    ----------
+    name : str
+        name of the stage, for example "load" or "write"
+    **labels
+        anything identifying what the stage worked on, for example metric="et" or region_set="CA_Counties_TIGER2016"
+
+    Records the wall time, CPU time, peak memory and memory before and after the code run inside the with block.
+    """
+    start = startStage()
+    try:
+        yield
+    finally:
+        endStage(start, name, labels)
+
+def iterStage(name:str, items, **labels):
+    """
+    Parameters
+    ----------
+    name : str
+        name of the stage, for example "load"
+    items : iterable
+        items produced lazily, for example models read one at a time by persad_data_analyze.iterModelsFromNetCDF
+    **labels
+        anything identifying what the stage worked on, see stage
+
+    Yields
+    ------
+    item
+        each item, producing each one is recorded as a separate stage (the work done with it between items is not)
+    """
+    iterator = iter(items)
+    while True:
+        start = startStage()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            endStage(start, name, labels, record=False)
+            return
+        except BaseException:
+            endStage(start, name, labels)
+            raise
+        endStage(start, name, labels)
+        yield item
+
+def recordRegion(region_set:str, name:str, **values) -> None:
+    # Per-region measurements, for example the time taken or the number of grid cells overlapping the region
+    region_records.append({'region_set':region_set, 'NAME':name, **values})
+
+def takeRecords() -> dict:
+    """
+    Returns
+    -------
+    dict
+        'stages' and 'regions' recorded by this process since the last call, which are then cleared
+    """
+    records = {'stages':list(stage_records), 'regions':list(region_records)}
+    stage_records.clear()
+    region_records.clear()
+    return records
+
+def summarizeRecords(task_records:dict, top_regions:int=10) -> dict:
+    """
+    Parameters
+    ----------
+    task_records : dict
+        records returned by takeRecords in each task, keyed by task name
+    top_regions : int, optional
+        number of most expensive regions to list for each region set. The default is 10.
+
+    Returns
+    -------
+    dict
+        'stages': total wall and CPU time, count, largest peak memory and largest growth in memory of every stage across all tasks,
+        'regions': the most expensive regions of each region set (by time if it was measured, otherwise by grid cells)
+    """
+    stages = {}
+    regions = {}
+    for records in task_records.values():
+        for record in records['stages']:
+            summary = stages.setdefault(record['stage'], {'count':0, 'wall':0.0, 'cpu':0.0, 'peak_rss_mb':0.0, 'growth_rss_mb':0.0, 'peak_is_per_stage':True})
+            summary['count'] += 1
+            summary['wall'] += record['wall']
+            summary['cpu'] += record['cpu']
+            summary['peak_rss_mb'] = max(summary['peak_rss_mb'], record['peak_rss_mb'])
+            # Memory the stage left behind (or released, if negative)
+            summary['growth_rss_mb'] = max(summary['growth_rss_mb'], record['end_rss_mb'] - record['start_rss_mb'])
+            summary['peak_is_per_stage'] = summary['peak_is_per_stage'] and record['peak_is_per_stage']
+        for record in records['regions']:
+            regions.setdefault(record['region_set'], []).append(record)
+    for region_set, records in regions.items():
+        key = 'wall' if all('wall' in record for record in records) else 'cells'
+        regions[region_set] = sorted(records, key=lambda record: record.get(key, 0), reverse=True)[:top_regions]
+    return {'stages':stages, 'regions':regions}
+
+def printSummary(summary:dict) -> None:
+    print("\nStage totals across all tasks:")
+    print("  {:<12} {:>6} {:>12} {:>12} {:>14} {:>16}".format("stage", "count", "wall (s)", "cpu (s)", "peak RSS (MB)", "RSS growth (MB)"))
+    for name, stage_summary in sorted(summary['stages'].items(), key=lambda item: item[1]['wall'], reverse=True):
+        # Without a way to reset the peak, it is the largest the process reached by the end of the stage
+        peak = "{:.0f}".format(stage_summary['peak_rss_mb']) + ("" if stage_summary['peak_is_per_stage'] else "*")
+        print("  {:<12} {:>6} {:>12.1f} {:>12.1f} {:>14} {:>16.0f}".format(name, stage_summary['count'], stage_summary['wall'], stage_summary['cpu'], peak, stage_summary['growth_rss_mb']))
+    if not all(stage_summary['peak_is_per_stage'] for stage_summary in summary['stages'].values()):
+        print("  * peak of the whole process, the peak could not be reset at the start of each stage")
+    for region_set, records in summary['regions'].items():
+        print("\nMost expensive regions in " + region_set + ":")
+        for record in records:
+            print("  " + ", ".join("{}={}".format(name, round(value, 3) if isinstance(value, float) else value) for name, value in record.items() if name != 'region_set'))
+
+def saveReport(path:str, summary:dict, task_records:dict, timings:dict) -> None:
+    # Everything recorded, so runs can be compared in detail later
+    with open(path, 'w') as f:
+        json.dump({'summary':summary, 'task_wall_times':timings, 'tasks':task_records}, f, indent=2, default=float)
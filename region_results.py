@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Compact columnar storage of the region results.
+
+Each region set is stored as a single uncompressed .npz file holding one row per region and one
+column per metric, RCP and product, along with the region names, indices and validity. Because the
+file is uncompressed, the values can be memory-mapped directly instead of parsing JSON.
+"""
+import numpy
+import scipy.stats
+import geopandas
+import shapely
+import math
+import os
+import struct
+import zipfile
+
+def saveRegionResults(path:str, names:numpy.ndarray, valid:numpy.ndarray, fields:numpy.ndarray, values:numpy.ndarray,
+                      metrics:numpy.ndarray, rcps:numpy.ndarray, products:numpy.ndarray) -> None:
+    """
+    Parameters
+    ----------
+    path : str
+        .npz file to write
+    names : numpy.ndarray
+        name of each region (one per row)
+    valid : numpy.ndarray
+        whether each region had valid geometry
+    fields : numpy.ndarray
+        label of each column, for example 'et_RCP85_totalaverage'
+    values : numpy.ndarray
+        (region, field) array of values
+    metrics : numpy.ndarray
+        metric of each column
+    rcps : numpy.ndarray
+        RCP of each column, for example 'RCP85'
+    products : numpy.ndarray
+        product of each column, for example 'totalaverage'
+
+    Returns
+    -------
+    None
+    """
+    # Write to a temporary file first so that readers never see a partially written file
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        numpy.savez(f, NAME=numpy.asarray(names, dtype=str), index=numpy.arange(len(names)), valid=numpy.asarray(valid, dtype=bool),
+                    fields=numpy.asarray(fields, dtype=str), metric=numpy.asarray(metrics, dtype=str), rcp=numpy.asarray(rcps, dtype=str),
+                    product=numpy.asarray(products, dtype=str), values=numpy.ascontiguousarray(values, dtype=numpy.float64))
+    os.replace(temp_path, path)
+
+def memmapNpzArray(path:str, name:str) -> numpy.memmap:
+    """
+    Parameters
+    ----------
+    path : str
+        uncompressed .npz file (as written by numpy.savez)
+    name : str
+        name of the array in the file
+
+    Returns
+    -------
+    numpy.memmap
+        read-only array mapped directly from the file without reading it
+    """
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + ".npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(name + " is compressed in " + path + " and can't be memory-mapped")
+    with open(path, 'rb') as f:
+        # Skip the zip local file header (30 bytes plus the file name and extra field) to get to the .npy data
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return numpy.memmap(path, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran_order else 'C')
+
+def loadRegionResults(path:str, mmap:bool=False) -> dict:
+    """
+    Parameters
+    ----------
+    path : str
+        .npz file written by saveRegionResults
+    mmap : bool, optional
+        memory-map the values instead of reading them into memory. The default is False.
+
+    Returns
+    -------
+    dict
+        every array in the file plus 'rows' (region name to row) and 'columns' (field label to column) lookups
+    """
+    with numpy.load(path) as results_file:
+        results = {name:results_file[name] for name in results_file.files if not (mmap and name == 'values')}
+    if mmap:
+        results['values'] = memmapNpzArray(path, 'values')
+    # If a name is used by more than one region, the first one is found by name
+    results['rows'] = {}
+    for row, name in enumerate(results['NAME'].tolist()):
+        results['rows'].setdefault(name, row)
+    results['columns'] = {field:column for column, field in enumerate(results['fields'].tolist())}
+    return results
+
+def getColumnRegions(results:dict, column:int) -> list:
+    """
+    Parameters
+    ----------
+    results : dict
+        region results from loadRegionResults
+    column : int
+        column of the field
+
+    Returns
+    -------
+    list of dict
+        'index', 'NAME', 'value' (NaN as None) and 'valid' of every region, the same list as the JSON files generate_region_data.py writes
+    """
+    return [{'index':index, 'NAME':name, 'value':None if math.isnan(value) else value, 'valid':valid} for index, name, value, valid
+            in zip(results['index'].tolist(), results['NAME'].tolist(), results['values'][:, column].tolist(), results['valid'].tolist())]
+
+def getRegionValues(results:dict, row:int) -> dict:
+    """
+    Parameters
+    ----------
+    results : dict
+        region results from loadRegionResults
+    row : int
+        row of the region
+
+    Returns
+    -------
+    dict
+        'index', 'NAME', 'valid' and 'values' of the region, with values nested by metric, RCP and product (NaN as None)
+    """
+    values = {}
+    for metric, rcp, product, value in zip(results['metric'].tolist(), results['rcp'].tolist(), results['product'].tolist(), results['values'][row].tolist()):
+        values.setdefault(metric, {}).setdefault(rcp, {})[product] = None if math.isnan(value) else value
+    return {'index':row, 'NAME':results['NAME'][row].item(), 'valid':bool(results['valid'][row]), 'values':values}
+
+def calculateComparisons(results:dict, high_rcp:str="RCP85", low_rcp:str="RCP45") -> list:
+    """
+    Parameters
+    ----------
+    results : dict
+        region results from loadRegionResults
+    high_rcp : str, optional
+        RCP the difference is taken from. The default is "RCP85".
+    low_rcp : str, optional
+        RCP subtracted from high_rcp. The default is "RCP45".
+
+    Returns
+    -------
+    list of dict
+        one comparison per metric and product with both RCPs: 'metric', 'product', 'delta' (high_rcp - low_rcp for each region),
+        'delta_rank' (1 for the largest delta), 'delta_percentile' and the percentile of each region's value under each RCP,
+        so regions can be compared across metrics. Regions without a value are NaN.
+    """
+    pairs = []
+    for column, (metric, rcp, product) in enumerate(zip(results['metric'].tolist(), results['rcp'].tolist(), results['product'].tolist())):
+        low_field = "{}_{}_{}".format(metric, low_rcp, product)
+        if rcp == high_rcp and low_field in results['columns']:
+            pairs.append((metric, product, column, results['columns'][low_field]))
+    if len(pairs) == 0:
+        return []
+    high_columns = [pair[2] for pair in pairs]
+    low_columns = [pair[3] for pair in pairs]
+    # Every comparison is computed at once over (region, pair) arrays
+    high = numpy.asarray(results['values'][:, high_columns], dtype=numpy.float64)
+    low = numpy.asarray(results['values'][:, low_columns], dtype=numpy.float64)
+    delta = high - low
+    delta_rank = scipy.stats.rankdata(-delta, axis=0, nan_policy='omit')
+    delta_percentile = getPercentiles(delta)
+    high_percentile = getPercentiles(high)
+    low_percentile = getPercentiles(low)
+    comparisons = []
+    for index, (metric, product, high_column, low_column) in enumerate(pairs):
+        comparisons.append({'metric':metric, 'product':product, 'delta':delta[:, index], 'delta_rank':delta_rank[:, index],
+                            'delta_percentile':delta_percentile[:, index], high_rcp + '_percentile':high_percentile[:, index],
+                            low_rcp + '_percentile':low_percentile[:, index]})
+    return comparisons
+
+def getPercentiles(values:numpy.ndarray) -> numpy.ndarray:
+    """
+    Parameters
+    ----------
+    values : numpy.ndarray
+        (region, column) array of values
+
+    Returns
+    -------
+    numpy.ndarray
+        percentile (0 to 100) of each value among the regions in its column, ties get the average, NaN values stay NaN
+    """
+    ranks = scipy.stats.rankdata(values, axis=0, nan_policy='omit')
+    counts = numpy.sum(~numpy.isnan(values), axis=0)
+    # A region alone in its column is in the middle
+    percentiles = numpy.divide((ranks - 1) * 100, counts - 1, out=numpy.full_like(ranks, 50.0), where=counts > 1)
+    percentiles[numpy.isnan(values)] = numpy.nan
+    return percentiles
+
+def buildRegionTree(shapefile_path:str) -> shapely.STRtree:
+    """
+    Parameters
+    ----------
+    shapefile_path : str
+        path to shapefile defining the regions (in the same order as the rows of the region results)
+
+    Returns
+    -------
+    shapely.STRtree
+        spatial index over the region geometries in lat/lon, the index of each geometry is the row of its region
+    """
+    geometries = shapely.make_valid(geopandas.read_file(shapefile_path).to_crs("epsg:4326").geometry.values)
+    # Prepared geometries make the point-in-polygon tests much faster
+    shapely.prepare(geometries)
+    return shapely.STRtree(geometries)
+
+def findRegionRows(tree:shapely.STRtree, lat:float, lon:float) -> list:
+    """
+    Parameters
+    ----------
+    tree : shapely.STRtree
+        spatial index from buildRegionTree
+    lat : float
+        latitude of the point
+    lon : float
+        longitude of the point
+
+    Returns
+    -------
+    list of int
+        rows of every region containing the point (usually one, none if the point is outside every region)
+    """
+    return sorted(tree.query(shapely.Point(lon, lat), predicate='intersects').tolist())
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Appendable storage of region averages over time.
+
+Each series is a NetCDF file with an unlimited time dimension holding a (time, field, region)
+array, chunked along time. Chunks of time steps are appended as they are calculated, so a long
+series never has to be held in memory, and the file can be opened lazily with xarray.
+"""
+import netCDF4
+import xarray
+import numpy
+
+def createRegionSeries(path:str, names:numpy.ndarray, valid:numpy.ndarray, fields:numpy.ndarray, time_chunk:int=120) -> None:
+    """
+    Parameters
+    ----------
+    path : str
+        NetCDF file to create (overwritten if it exists)
+    names : numpy.ndarray
+        name of each region
+    valid : numpy.ndarray
+        whether each region had valid geometry
+    fields : numpy.ndarray
+        label of each field, for example 'et_RCP85'
+    time_chunk : int, optional
+        number of time steps stored together in a chunk, usually the number appended at once. The default is 120.
+
+    Returns
+    -------
+    None
+    """
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.createDimension('time', None)
+        dataset.createDimension('field', len(fields))
+        dataset.createDimension('region', len(names))
+        dataset.createVariable('time', 'f8', ('time',))
+        dataset.createVariable('NAME', str, ('region',))[:] = numpy.asarray(names, dtype=object)
+        dataset.createVariable('valid', 'u1', ('region',))[:] = numpy.asarray(valid, dtype=numpy.uint8)
+        dataset.createVariable('field', str, ('field',))[:] = numpy.asarray([str(field) for field in fields], dtype=object)
+        dataset.createVariable('values', 'f8', ('time', 'field', 'region'), chunksizes=(time_chunk, len(fields), len(names)), fill_value=numpy.nan)
+
+def appendRegionSeries(path:str, times:numpy.ndarray, values:numpy.ndarray) -> int:
+    """
+    Parameters
+    ----------
+    path : str
+        NetCDF file created by createRegionSeries
+    times : numpy.ndarray
+        time of each step (datetime64, cftime dates or plain numbers)
+    values : numpy.ndarray
+        (time, field, region) array of region averages for those time steps
+
+    Returns
+    -------
+    int
+        number of time steps in the file after appending
+    """
+    with netCDF4.Dataset(path, 'a') as dataset:
+        time = dataset['time']
+        times = numpy.asarray(times)
+        if times.dtype.kind in ('M', 'O'):
+            # Dates are stored as numbers in the units and calendar chosen for the first time steps
+            if 'units' in time.ncattrs():
+                times = xarray.coding.times.encode_cf_datetime(times, time.units, time.calendar)[0]
+            else:
+                times, units, calendar = xarray.coding.times.encode_cf_datetime(times)
+                time.units = units
+                time.calendar = calendar
+        start = len(time)
+        time[start:start + len(times)] = times
+        dataset['values'][start:start + len(times)] = values
+        return start + len(times)
+
+def loadRegionSeries(path:str) -> xarray.DataArray:
+    """
+    Parameters
+    ----------
+    path : str
+        NetCDF file written by createRegionSeries and appendRegionSeries
+
+    Returns
+    -------
+    xarray.DataArray
+        lazily loaded (time, field, region) array of region averages, with the region names and validity as coordinates
+    """
+    dataset = xarray.open_dataset(path)
+    return dataset['values'].assign_coords(region=numpy.arange(dataset.sizes['region']), NAME=dataset['NAME'], valid=dataset['valid'].astype(bool))
+
+def resampleRegionSeries(series:xarray.DataArray, period:str="decade") -> xarray.DataArray:
+    """
+    Parameters
+    ----------
+    series : xarray.DataArray
+        array with a time dimension of dates, such as one from loadRegionSeries
+    period : str, optional
+        "year" or "decade", the period every value is averaged over. The default is "decade".
+
+    Returns
+    -------
+    xarray.DataArray
+        mean over each period, with a 'year' or 'decade' dimension (labelled by the first year of the decade) instead of time
+    """
+    years = series['time'].dt.year
+    if period == "year":
+        return series.groupby(years.rename('year')).mean('time')
+    elif period == "decade":
+        return series.groupby((years // 10 * 10).rename('decade')).mean('time')
+    raise ValueError("Unknown period: " + str(period))
@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+"""
+Region weighting functions for Dr. Persad's Hydroclimate Research.
+
+Computes the fraction of each region's area covered by each data grid cell as a sparse
+(region, cell) matrix, so that the weighted average of a metric over every region is a
+single sparse matrix-vector product instead of one polygon intersection per grid cell.
+
+The weights only depend on the grid and the shapefile, so they are cached on disk as .npz
+files keyed by a hash of the grid coordinates, the shapefile contents and the weighting options.
+
+Areas are measured either in degrees (the original behaviour) or in an equal-area projection,
+where every region and grid cell is projected once and the overlaps are exact areas in m^2.
+
+The overlaps are either exact polygon intersections, or approximated by rasterizing every region
+onto a supersampled copy of the grid and counting the subcells of each grid cell inside each region.
+"""
+import numpy
+import shapely
+import geopandas
+import pyproj
+import rasterio.features
+from affine import Affine
+import hashlib
+import glob
+import os
+from scipy import sparse
+
+# Bump this whenever the weight calculation changes so that old cache files are not reused
+WEIGHTS_VERSION = 2
+
+# "exact" intersects every region with every grid cell, "raster" approximates the overlaps with supersampled masks
+WEIGHT_METHODS = ("exact", "raster")
+
+# "degrees" measures areas in lat/lon degrees, "equal_area" in EQUAL_AREA_CRS
+AREA_MODES = ("degrees", "equal_area")
+# World Cylindrical Equal Area: x only depends on longitude and y only on latitude, so grid cells stay rectangles
+EQUAL_AREA_CRS = "epsg:6933"
+
+# Grid hash -> projected bounds of every grid cell, so each grid is only projected once per process
+projected_cell_bounds = {}
+
+def getCellEdges(centers:numpy.ndarray) -> numpy.ndarray:
+    """
+    Parameters
+    ----------
+    centers : numpy.ndarray
+        1D array of evenly spaced grid cell center coordinates
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        2D array of shape (n, 2) containing the lower and upper edge of each grid cell
+    """
+    # Same cell radius as the original per-cell calculation: half the spacing of the first two points
+    radius = abs(centers[1] - centers[0]) / 2
+    return numpy.stack([centers - radius, centers + radius], axis=1)
+
+def getCellBounds(lat:numpy.ndarray, lon:numpy.ndarray) -> tuple:
+    """
+    Parameters
+    ----------
+    lat : numpy.ndarray
+        1D array of grid cell center latitudes
+    lon : numpy.ndarray
+        1D array of grid cell center longitudes
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        (lon_min, lat_min, lon_max, lat_max) of every grid cell, flattened in (lat, lon) order
+    """
+    lat_edges = getCellEdges(lat)
+    lon_edges = getCellEdges(lon)
+    # Meshgrid returns arrays of shape (lat, lon), which matches the order the data is flattened in
+    lon_min, lat_min = numpy.meshgrid(lon_edges[:, 0], lat_edges[:, 0])
+    lon_max, lat_max = numpy.meshgrid(lon_edges[:, 1], lat_edges[:, 1])
+    return (lon_min.ravel(), lat_min.ravel(), lon_max.ravel(), lat_max.ravel())
+
+def getGridHash(lat:numpy.ndarray, lon:numpy.ndarray) -> str:
+    digest = hashlib.sha256()
+    digest.update(numpy.ascontiguousarray(lat, dtype=numpy.float64).tobytes())
+    digest.update(b'|')
+    digest.update(numpy.ascontiguousarray(lon, dtype=numpy.float64).tobytes())
+    return digest.hexdigest()
+
+def getEqualAreaTransformer() -> pyproj.Transformer:
+    return pyproj.Transformer.from_crs("epsg:4326", EQUAL_AREA_CRS, always_xy=True)
+
+def getProjectedCellBounds(lat:numpy.ndarray, lon:numpy.ndarray) -> tuple:
+    """
+    Parameters
+    ----------
+    lat : numpy.ndarray
+        1D array of grid cell center latitudes
+    lon : numpy.ndarray
+        1D array of grid cell center longitudes
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        (x_min, y_min, x_max, y_max) of every grid cell in EQUAL_AREA_CRS meters, flattened in (lat, lon) order
+    """
+    key = getGridHash(lat, lon)
+    if key not in projected_cell_bounds:
+        lat_edges = getCellEdges(lat)
+        lon_edges = getCellEdges(lon)
+        transformer = getEqualAreaTransformer()
+        # Only the cell edges need projecting: x depends on longitude alone and y on latitude alone
+        x_edges = transformer.transform(lon_edges, numpy.zeros_like(lon_edges))[0]
+        y_edges = transformer.transform(numpy.zeros_like(lat_edges), numpy.clip(lat_edges, -90, 90))[1]
+        x_min, y_min = numpy.meshgrid(x_edges[:, 0], y_edges[:, 0])
+        x_max, y_max = numpy.meshgrid(x_edges[:, 1], y_edges[:, 1])
+        projected_cell_bounds[key] = (x_min.ravel(), y_min.ravel(), x_max.ravel(), y_max.ravel())
+    return projected_cell_bounds[key]
+
+def getCellAreas(lat:numpy.ndarray, lon:numpy.ndarray, area_mode:str="degrees") -> numpy.ndarray:
+    """
+    Parameters
+    ----------
+    lat : numpy.ndarray
+        1D array of grid cell center latitudes
+    lon : numpy.ndarray
+        1D array of grid cell center longitudes
+    area_mode : str, optional
+        "degrees" for areas in square degrees, "equal_area" for areas in m^2. The default is "degrees".
+
+    Returns
+    -------
+    numpy.ndarray
+        (lat, lon) array of the area of every grid cell
+    """
+    if area_mode == "equal_area":
+        x_min, y_min, x_max, y_max = getProjectedCellBounds(lat, lon)
+    elif area_mode == "degrees":
+        x_min, y_min, x_max, y_max = getCellBounds(lat, lon)
+    else:
+        raise ValueError("Unknown area mode: " + str(area_mode))
+    return ((x_max - x_min) * (y_max - y_min)).reshape(len(lat), len(lon))
+
+def projectGeometries(geometries:numpy.ndarray) -> numpy.ndarray:
+    # Project lat/lon geometries to EQUAL_AREA_CRS, every coordinate of every geometry at once
+    transformer = getEqualAreaTransformer()
+    return shapely.transform(geometries, lambda coordinates: numpy.column_stack(transformer.transform(coordinates[:, 0], coordinates[:, 1])))
+
+def calculateOverlapWeights(geometries:numpy.ndarray, lat:numpy.ndarray, lon:numpy.ndarray, all_touched:bool=True, area_mode:str="degrees") -> tuple:
+    """
+    Parameters
+    ----------
+    geometries : numpy.ndarray
+        array of shapely geometries defining each region, in the same CRS as the grid (lat/lon degrees)
+    lat : numpy.ndarray
+        1D array of grid cell center latitudes
+    lon : numpy.ndarray
+        1D array of grid cell center longitudes
+    all_touched : bool, optional
+        include every cell the region touches, otherwise only cells with their center inside the region. The default is True.
+    area_mode : str, optional
+        "degrees" measures the overlaps in lat/lon degrees, "equal_area" projects the regions and cells to EQUAL_AREA_CRS first. The default is "degrees".
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        matrix of shape (region, lat * lon) with the fraction of each region's area that overlaps each grid cell
+    valid : numpy.ndarray
+        boolean array indicating whether or not each region had valid geometry to calculate weights with
+    """
+    geometries = numpy.asarray(geometries, dtype=object)
+    lon_center, lat_center = numpy.meshgrid(lon, lat)
+    lon_center = lon_center.ravel()
+    lat_center = lat_center.ravel()
+
+    # Regions with invalid geometry are repaired so they can still be intersected, but they are flagged as invalid
+    valid = shapely.is_valid(geometries)
+    geometries = numpy.where(valid, geometries, shapely.make_valid(geometries))
+
+    if area_mode == "equal_area":
+        # Everything is projected once, after which every area is in m^2
+        geometries = projectGeometries(geometries)
+        cells = shapely.box(*getProjectedCellBounds(lat, lon))
+        centers = shapely.points(numpy.column_stack(getEqualAreaTransformer().transform(lon_center, lat_center)))
+    elif area_mode == "degrees":
+        cells = shapely.box(*getCellBounds(lat, lon))
+        centers = shapely.points(lon_center, lat_center)
+    else:
+        raise ValueError("Unknown area mode: " + str(area_mode))
+    # Find every candidate (region, cell) pair at once using a spatial index over the grid
+    cell_tree = shapely.STRtree(cells if all_touched else centers)
+    region_index, cell_index = cell_tree.query(geometries, predicate='intersects')
+
+    # Cells entirely inside their region overlap by their whole area, only cells on a region boundary need an intersection
+    shapely.prepare(geometries)
+    overlap_area = shapely.area(cells[cell_index])
+    boundary = ~shapely.contains_properly(geometries[region_index], cells[cell_index])
+    overlap_area[boundary] = shapely.area(shapely.intersection(geometries[region_index[boundary]], cells[cell_index[boundary]]))
+    total_area = shapely.area(geometries)
+
+    # Weight of each cell is the fraction of the total region area that it covers
+    region_area = total_area[region_index]
+    fraction = numpy.divide(overlap_area, region_area, out=numpy.zeros_like(overlap_area), where=region_area > 0)
+
+    weights = sparse.csr_matrix((fraction, (region_index, cell_index)), shape=(len(geometries), len(cells)))
+    weights.eliminate_zeros()
+    return (weights, valid)
+
+def applyWeights(weights:sparse.csr_matrix, data:numpy.ndarray) -> numpy.ndarray:
+    """
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        (region, cell) weight matrix from calculateOverlapWeights
+    data : numpy.ndarray
+        array of shape (lat, lon), or (..., lat, lon) to average several fields at once, to average over each region
+
+    Returns
+    -------
+    numpy.ndarray
+        weighted average of the data for each region with shape (region, ...), NaN cells do not contribute to the average
+    """
+    data = numpy.asarray(data, dtype=float)
+    # Every field is a column of a (cell, field) matrix so all of them are averaged in a single sparse product
+    fields = data.reshape(-1, weights.shape[1]).T
+    values = weights @ numpy.where(numpy.isnan(fields), 0, fields)
+    return values.reshape((weights.shape[0],) + data.shape[:-2])
+
+def parseStatistic(name:str) -> tuple:
+    """
+    Parameters
+    ----------
+    name : str
+        "mean", "std", "min", "max", "iqr", "p<q>" (weighted q-th percentile, for example "p25") or "ge<k>" (fraction of the
+        area with a value of at least k, for example "ge8" for the area where 8 or more models agree)
+
+    Returns
+    -------
+    tuple
+        (kind, parameter) for example ("percentile", 25.0) or ("std", None)
+    """
+    if name in ("mean", "std", "min", "max", "iqr"):
+        return (name, None)
+    try:
+        if name.startswith("p") and 0 <= float(name[1:]) <= 100:
+            return ("percentile", float(name[1:]))
+        if name.startswith("ge"):
+            return ("at_least", float(name[2:]))
+    except ValueError:
+        pass
+    raise ValueError("Unknown region statistic: " + str(name))
+
+def applyWeightStatistics(weights:sparse.csr_matrix, data:numpy.ndarray, statistics:list) -> dict:
+    """
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        (region, cell) weight matrix from calculateOverlapWeights or calculateRasterWeights
+    data : numpy.ndarray
+        array of shape (lat, lon), or (..., lat, lon) for several fields at once
+    statistics : list of str
+        statistics to calculate, see parseStatistic
+
+    Returns
+    -------
+    dict
+        each statistic's (region, ...) array. "mean" is the same as applyWeights (NaN cells count as 0). The other statistics are
+        area-weighted over the grid cells overlapping each region, leaving out NaN cells, and are NaN for regions without any.
+    """
+    data = numpy.asarray(data, dtype=float)
+    shape = (weights.shape[0],) + data.shape[:-2]
+    fields = data.reshape(-1, weights.shape[1]).T
+    missing = numpy.isnan(fields)
+    # Sums of the weights of the cells with data, to normalize by
+    totals = weights @ (~missing).astype(float)
+    has_data = totals > 0
+    parsed = {name:parseStatistic(name) for name in statistics}
+    # Value and weight of every (region, cell) overlap, in the order of the sparse matrix, for the order statistics
+    entry_values = fields[weights.indices]
+    entry_rows = numpy.repeat(numpy.arange(weights.shape[0]), numpy.diff(weights.indptr))
+    starts = weights.indptr[:-1][numpy.diff(weights.indptr) > 0]
+    percentiles = {}
+    
+    results = {}
+    for name, (kind, parameter) in parsed.items():
+        if kind == "mean":
+            result = weights @ numpy.where(missing, 0, fields)
+        elif kind == "std":
+            mean = numpy.divide(weights @ numpy.where(missing, 0, fields), totals, out=numpy.full(totals.shape, numpy.nan), where=has_data)
+            # Squared differences from each region's mean (two passes, so uniform regions don't get round-off spread)
+            squares = weights.data[:, numpy.newaxis] * numpy.nan_to_num((entry_values - mean[entry_rows]) ** 2)
+            result = numpy.full(totals.shape, numpy.nan)
+            if len(starts) > 0:
+                rows = numpy.diff(weights.indptr) > 0
+                result[rows] = numpy.sqrt(numpy.divide(numpy.add.reduceat(squares, starts, axis=0), totals[rows], out=numpy.full(totals[rows].shape, numpy.nan), where=has_data[rows]))
+        elif kind in ("min", "max"):
+            result = numpy.full(totals.shape, numpy.nan)
+            # Reduced over each region's entries at once, NaN cells are skipped by fmin/fmax
+            if len(starts) > 0:
+                reduce = numpy.fmin if kind == "min" else numpy.fmax
+                result[numpy.diff(weights.indptr) > 0] = reduce.reduceat(entry_values, starts, axis=0)
+        elif kind == "at_least":
+            result = numpy.divide(weights @ (fields >= parameter).astype(float), totals, out=numpy.full(totals.shape, numpy.nan), where=has_data)
+        else:
+            for q in ([25.0, 75.0] if kind == "iqr" else [parameter]):
+                if q not in percentiles:
+                    percentiles[q] = getWeightedPercentile(weights, entry_values, entry_rows, q)
+            result = percentiles[75.0] - percentiles[25.0] if kind == "iqr" else percentiles[parameter]
+        results[name] = result.reshape(shape)
+    return results
+
+def getWeightedPercentile(weights:sparse.csr_matrix, entry_values:numpy.ndarray, entry_rows:numpy.ndarray, q:float) -> numpy.ndarray:
+    """
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        (region, cell) weight matrix
+    entry_values : numpy.ndarray
+        (entry, field) value of the cell of each entry of the matrix
+    entry_rows : numpy.ndarray
+        region of each entry of the matrix
+    q : float
+        percentile (0 - 100)
+
+    Returns
+    -------
+    numpy.ndarray
+        (region, field) smallest cell value whose cumulative share of the region's area (with data) reaches q percent
+    """
+    result = numpy.full((weights.shape[0], entry_values.shape[1]), numpy.nan)
+    # Regions without any cells (for example outside the grid) have no entries, indptr of those rows points past the last entry
+    counts = numpy.diff(weights.indptr)
+    starts = weights.indptr[:-1][counts > 0]
+    for field in range(entry_values.shape[1]):
+        values = entry_values[:, field]
+        entry_weights = numpy.where(numpy.isnan(values), 0, weights.data)
+        # Sort the cells of each region by value (regions stay in order), NaN cells sort last with no weight
+        order = numpy.lexsort((values, entry_rows))
+        sorted_weights = entry_weights[order]
+        totals = numpy.bincount(entry_rows, weights=sorted_weights, minlength=weights.shape[0])
+        # Cumulative share of each region's area, restarting at every region
+        cumulative = numpy.cumsum(sorted_weights)
+        cumulative -= numpy.repeat(cumulative[starts] - sorted_weights[starts], counts[counts > 0])
+        share = numpy.divide(cumulative, totals[entry_rows], out=numpy.zeros_like(cumulative), where=totals[entry_rows] > 0)
+        # The first cell reaching the percentile comes right after all the cells below it
+        below = numpy.bincount(entry_rows, weights=(share < q / 100 - 1e-12), minlength=weights.shape[0]).astype(int)
+        has_data = totals > 0
+        position = weights.indptr[:-1][has_data] + below[has_data]
+        result[has_data, field] = values[order][numpy.minimum(position, weights.indptr[1:][has_data] - 1)]
+    return result
+
+def getRasterGroups(geometries:numpy.ndarray) -> list:
+    """
+    Parameters
+    ----------
+    geometries : numpy.ndarray
+        array of shapely geometries defining each region
+
+    Returns
+    -------
+    list of numpy.ndarray
+        indices of the regions in each group, no two regions in a group overlap so each group can be burned into one raster
+    """
+    tree = shapely.STRtree(geometries)
+    conflicts = [set() for index in range(len(geometries))]
+    for predicate in ('overlaps', 'contains', 'within'):
+        for first, second in zip(*tree.query(geometries, predicate=predicate)):
+            if first != second:
+                conflicts[first].add(second)
+    # Greedily put each region in the first group without a region it overlaps
+    group_of = numpy.full(len(geometries), -1)
+    for index in range(len(geometries)):
+        taken = set(group_of[list(conflicts[index])].tolist())
+        group = 0
+        while group in taken:
+            group += 1
+        group_of[index] = group
+    return [numpy.flatnonzero(group_of == group) for group in range(group_of.max() + 1)] if len(geometries) > 0 else []
+
+def calculateRasterWeights(geometries:numpy.ndarray, lat:numpy.ndarray, lon:numpy.ndarray, supersample:int=4, area_mode:str="degrees",
+                           band_rows:int=32) -> tuple:
+    """
+    Parameters
+    ----------
+    geometries : numpy.ndarray
+        array of shapely geometries defining each region, in lat/lon degrees
+    lat : numpy.ndarray
+        1D array of evenly spaced grid cell center latitudes
+    lon : numpy.ndarray
+        1D array of evenly spaced grid cell center longitudes
+    supersample : int, optional
+        each grid cell is split into supersample x supersample subcells, higher is more accurate and slower. The default is 4.
+    area_mode : str, optional
+        "degrees" or "equal_area", how the subcell and region areas are measured. The default is "degrees".
+    band_rows : int, optional
+        number of grid rows rasterized at once, limits the memory used by the supersampled raster. The default is 32.
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        matrix of shape (region, lat * lon) with the approximate fraction of each region's area that overlaps each grid cell
+    valid : numpy.ndarray
+        boolean array indicating whether or not each region had valid geometry
+    error_bound : numpy.ndarray
+        upper bound on the total error of each region's weights (sum of absolute errors): only subcells within one subcell
+        diagonal of the boundary can be misclassified, so the error is at most perimeter * subcell diagonal / area
+    """
+    geometries = numpy.asarray(geometries, dtype=object)
+    valid = shapely.is_valid(geometries)
+    geometries = numpy.where(valid, geometries, shapely.make_valid(geometries))
+    lat_step = lat[1] - lat[0]
+    lon_step = lon[1] - lon[0]
+    # Subcell edges along each axis, in grid order
+    fine_lat_edges = lat[0] - lat_step / 2 + numpy.arange(len(lat) * supersample + 1) * lat_step / supersample
+
+    if area_mode == "equal_area":
+        transformer = getEqualAreaTransformer()
+        # In the cylindrical projection every subcell in a row has the same width and height
+        subcell_width = abs(numpy.diff(transformer.transform(numpy.array([0, lon_step / supersample]), numpy.zeros(2))[0])[0])
+        subcell_heights = numpy.abs(numpy.diff(transformer.transform(numpy.zeros_like(fine_lat_edges), numpy.clip(fine_lat_edges, -90, 90))[1]))
+        measured = projectGeometries(geometries)
+    elif area_mode == "degrees":
+        subcell_width = abs(lon_step) / supersample
+        subcell_heights = numpy.full(len(fine_lat_edges) - 1, abs(lat_step) / supersample)
+        measured = geometries
+    else:
+        raise ValueError("Unknown area mode: " + str(area_mode))
+    subcell_areas = subcell_width * subcell_heights
+    region_area = shapely.area(measured)
+    subcell_diagonal = numpy.hypot(subcell_width, subcell_heights.max())
+    error_bound = numpy.divide(shapely.length(measured) * subcell_diagonal, region_area, out=numpy.zeros_like(region_area), where=region_area > 0)
+
+    # Subcells are burned with the index of the region their center is in, band by band so the raster stays small
+    transform = Affine(lon_step / supersample, 0, lon[0] - lon_step / 2, 0, lat_step / supersample, lat[0] - lat_step / 2)
+    tree = shapely.STRtree(geometries)
+    # Converted to GeoJSON once instead of again for every band (regions without geometry are never queried from the tree)
+    shapes = [geometry.__geo_interface__ if geometry is not None else None for geometry in geometries]
+    region_index = []
+    cell_index = []
+    overlap_area = []
+    for band_start in range(0, len(lat), band_rows):
+        band_end = min(band_start + band_rows, len(lat))
+        band_lats = fine_lat_edges[[band_start * supersample, band_end * supersample]]
+        band_box = shapely.box(lon[0] - lon_step / 2, band_lats.min(), lon[-1] + lon_step / 2, band_lats.max())
+        # Only the regions that reach this band are rasterized
+        indices = tree.query(band_box, predicate='intersects')
+        if len(indices) == 0:
+            continue
+        options = {'out_shape':((band_end - band_start) * supersample, len(lon) * supersample),
+                   'transform':transform * Affine.translation(0, band_start * supersample)}
+        # A subcell can only hold one label, so if any regions overlap in this band they are burned in groups that don't overlap
+        coverage = rasterio.features.rasterize(((shapes[index], 1) for index in indices), fill=0, dtype='uint16', merge_alg=rasterio.features.MergeAlg.add, **options)
+        groups = [indices] if coverage.max() <= 1 else [indices[group] for group in getRasterGroups(geometries[indices])]
+        for group in groups:
+            labels = rasterio.features.rasterize(((shapes[index], index) for index in group), fill=-1, dtype='int32', **options)
+            fine_row, fine_col = numpy.nonzero(labels >= 0)
+            region_index.append(labels[fine_row, fine_col])
+            # Block sum: every subcell adds its area to the grid cell it belongs to
+            cell_index.append((band_start + fine_row // supersample) * len(lon) + fine_col // supersample)
+            overlap_area.append(subcell_areas[band_start * supersample + fine_row])
+    region_index = numpy.concatenate(region_index) if len(region_index) > 0 else numpy.zeros(0, dtype=int)
+    cell_index = numpy.concatenate(cell_index) if len(cell_index) > 0 else numpy.zeros(0, dtype=int)
+    overlap_area = numpy.concatenate(overlap_area) if len(overlap_area) > 0 else numpy.zeros(0)
+
+    # Regions too small to contain a subcell center get their whole area in the cell containing a point inside them
+    covered = numpy.zeros(len(geometries), dtype=bool)
+    covered[region_index] = True
+    missing = numpy.flatnonzero(~covered & (region_area > 0))
+    points = shapely.point_on_surface(geometries[missing])
+    row = numpy.floor((shapely.get_y(points) - (lat[0] - lat_step / 2)) / lat_step).astype(int)
+    column = numpy.floor((shapely.get_x(points) - (lon[0] - lon_step / 2)) / lon_step).astype(int)
+    inside = (row >= 0) & (row < len(lat)) & (column >= 0) & (column < len(lon))
+    region_index = numpy.concatenate([region_index, missing[inside]])
+    cell_index = numpy.concatenate([cell_index, row[inside] * len(lon) + column[inside]])
+    overlap_area = numpy.concatenate([overlap_area, region_area[missing[inside]]])
+
+    # Duplicate (region, cell) pairs are summed when the matrix is built
+    overlap = sparse.csr_matrix((overlap_area, (region_index, cell_index)), shape=(len(geometries), len(lat) * len(lon)))
+    row_area = numpy.repeat(region_area, numpy.diff(overlap.indptr))
+    overlap.data = numpy.divide(overlap.data, row_area, out=numpy.zeros_like(overlap.data), where=row_area > 0)
+    overlap.eliminate_zeros()
+    return (overlap, valid, error_bound)
+
+def hashShapefile(shapefile_path:str) -> str:
+    """
+    Parameters
+    ----------
+    shapefile_path : str
+        path to the .shp file, every sidecar file with the same name (.dbf, .prj, .shx, ...) is hashed as well
+
+    Returns
+    -------
+    str
+        SHA-256 hex digest of the contents of all files making up the shapefile
+    """
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(glob.escape(os.path.splitext(shapefile_path)[0]) + ".*")):
+        # Skip metadata that doesn't affect the geometry or attributes
+        if path.endswith(".xml"):
+            continue
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def getWeightsKey(shapefile_path:str, shapefile_variable:str, lat:numpy.ndarray, lon:numpy.ndarray, all_touched:bool=True, area_mode:str="degrees",
+                  method:str="exact", supersample:int=4) -> str:
+    """
+    Parameters
+    ----------
+    shapefile_path : str
+        path to shapefile defining the regions
+    shapefile_variable : str
+        name of variable in the shapefile used for labeling regions
+    lat : numpy.ndarray
+        1D array of grid cell center latitudes
+    lon : numpy.ndarray
+        1D array of grid cell center longitudes
+    all_touched : bool, optional
+        whether every touched cell is included in a region. The default is True.
+    area_mode : str, optional
+        how the areas are measured. The default is "degrees".
+    method : str, optional
+        how the overlaps are calculated. The default is "exact".
+    supersample : int, optional
+        subcells per grid cell along each axis (raster method only). The default is 4.
+
+    Returns
+    -------
+    str
+        hash identifying a set of weights, changes whenever the grid, shapefile or options change
+    """
+    digest = hashlib.sha256()
+    # Options that don't affect the chosen method are left out, so they don't invalidate the cache
+    options = (bool(all_touched),) if method == "exact" else (int(supersample),)
+    digest.update(str((WEIGHTS_VERSION, shapefile_variable, area_mode, method) + options).encode())
+    digest.update(getGridHash(lat, lon).encode())
+    digest.update(hashShapefile(shapefile_path).encode())
+    return digest.hexdigest()
+
+def saveWeights(path:str, weights:sparse.csr_matrix, valid:numpy.ndarray, names:numpy.ndarray, error_bound:numpy.ndarray) -> None:
+    """
+    Parameters
+    ----------
+    path : str
+        .npz file to write the weights to
+    weights : scipy.sparse.csr_matrix
+        (region, cell) weight matrix
+    valid : numpy.ndarray
+        boolean array indicating whether each region had valid geometry
+    names : numpy.ndarray
+        name of each region
+    error_bound : numpy.ndarray
+        upper bound on the error of each region's weights
+
+    Returns
+    -------
+    None
+    """
+    # Write to a temporary file first so that other processes never read a partially written cache file
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, 'wb') as f:
+        numpy.savez(f, data=weights.data, indices=weights.indices, indptr=weights.indptr, shape=numpy.array(weights.shape),
+                    valid=valid, names=numpy.asarray(names, dtype=str), error_bound=error_bound)
+    os.replace(temp_path, path)
+
+def loadWeights(path:str) -> tuple:
+    """
+    Parameters
+    ----------
+    path : str
+        .npz file written by saveWeights
+
+    Returns
+    -------
+    tuple
+        (weights, valid, names, error_bound) as saved
+    """
+    with numpy.load(path) as cached:
+        weights = sparse.csr_matrix((cached['data'], cached['indices'], cached['indptr']), shape=tuple(cached['shape']))
+        return (weights, cached['valid'], cached['names'], cached['error_bound'])
+
+def getRegionWeights(shapefile_path:str, shapefile_variable:str, lat:numpy.ndarray, lon:numpy.ndarray, all_touched:bool=True, cache_dir:str=None,
+                     area_mode:str="degrees", method:str="exact", supersample:int=4) -> tuple:
+    """
+    Parameters
+    ----------
+    shapefile_path : str
+        path to shapefile to use for defining regions
+    shapefile_variable : str
+        name of variable to extract from shapefile for labeling regions
+    lat : numpy.ndarray
+        1D array of grid cell center latitudes (-90 to 90)
+    lon : numpy.ndarray
+        1D array of grid cell center longitudes (-180 to 180)
+    all_touched : bool, optional
+        include every cell the region touches, otherwise only cells with their center inside the region. The default is True.
+    cache_dir : str, optional
+        directory to cache weights in, weights are always recalculated if not specified. The default is None.
+    area_mode : str, optional
+        "degrees" or "equal_area", see calculateOverlapWeights. The default is "degrees".
+    method : str, optional
+        "exact" polygon intersections or "raster" supersampled masks (see calculateRasterWeights). The default is "exact".
+    supersample : int, optional
+        subcells per grid cell along each axis for the raster method. The default is 4.
+
+    Returns
+    -------
+    tuple
+        (weights, valid, names, error_bound) where weights is the sparse (region, cell) matrix, valid flags regions with valid geometry,
+        names labels each region and error_bound bounds the error of each region's weights (0 for the exact method)
+    """
+    if method not in WEIGHT_METHODS:
+        raise ValueError("Unknown weight method: " + str(method))
+    cache_path = None
+    if cache_dir is not None:
+        key = getWeightsKey(shapefile_path, shapefile_variable, lat, lon, all_touched, area_mode, method, supersample)
+        cache_path = os.path.join(cache_dir, os.path.splitext(os.path.basename(shapefile_path))[0] + "_" + key[:16] + ".npz")
+        if os.path.isfile(cache_path):
+            return loadWeights(cache_path)
+
+    # Read shapefile and project every region to the same CRS as the data at once
+    shapefile = geopandas.read_file(shapefile_path).to_crs("epsg:4326")
+    if method == "raster":
+        weights, valid, error_bound = calculateRasterWeights(shapefile.geometry.values, lat, lon, supersample, area_mode)
+    else:
+        weights, valid = calculateOverlapWeights(shapefile.geometry.values, lat, lon, all_touched, area_mode)
+        error_bound = numpy.zeros(len(valid))
+    names = numpy.asarray(shapefile[shapefile_variable], dtype=str)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        saveWeights(cache_path, weights, valid, names, error_bound)
+    return (weights, valid, names, error_bound)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the region averages in generate_region_data.py, run with python -m pytest tests
+"""
+import os
+import sys
+import numpy
+import xarray
+import geopandas
+import shapely
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate_region_data as gdata
+
+def writeRegions(path:str) -> str:
+    # Boxes on a 1 degree grid from 0 to 4: one across two cells, one partly on the NaN cell, one across four cells and a bowtie
+    bowtie = shapely.Polygon([(0.2, 2.2), (1.8, 3.8), (1.8, 2.2), (0.2, 3.8), (0.2, 2.2)])
+    geometries = [shapely.box(0.5, 0.5, 2.5, 1.5), shapely.box(0, 0, 1.5, 1.5), shapely.box(2.2, 2.1, 3.9, 3.7), bowtie]
+    regions = geopandas.GeoDataFrame({'NAME':["two_cells", "nan_cell", "four_cells", "bowtie"]}, geometry=geometries, crs="epsg:4326")
+    regions.to_file(path)
+    return path
+
+def makeGrid() -> xarray.DataArray:
+    values = numpy.arange(16, dtype=float).reshape(4, 4)
+    values[0, 0] = numpy.nan
+    return xarray.DataArray(values, dims=('lat', 'lon'), coords={'lat':numpy.arange(0.5, 4, 1.0), 'lon':numpy.arange(0.5, 4, 1.0)})
+
+def test_sparse_weights_match_per_cell(tmp_path):
+    path = writeRegions(str(tmp_path / "regions.shp"))
+    data = makeGrid()
+    sparse_regions, sparse_values = gdata.analyzeRegions(path, "NAME", data, weight_mode="sparse")
+    cell_regions, cell_values = gdata.analyzeRegions(path, "NAME", data, weight_mode="cell")
+    assert [region['NAME'] for region in sparse_regions] == [region['NAME'] for region in cell_regions]
+    assert [region['valid'] for region in sparse_regions] == [region['valid'] for region in cell_regions] == [True, True, True, False]
+    # The per-cell loop stops at the first cell of an invalid region, so only the valid regions have comparable values
+    numpy.testing.assert_allclose(sparse_values[:3], cell_values[:3], rtol=1e-12)
+    # A NaN cell adds nothing but still counts towards the region's area, in both modes
+    numpy.testing.assert_allclose(sparse_values[1], (0.5 * 1 + 0.5 * 4 + 0.25 * 5) / 2.25, rtol=1e-12)
+    numpy.testing.assert_allclose(sparse_values[0], 3.0, rtol=1e-12)
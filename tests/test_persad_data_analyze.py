@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the one-pass ensemble in persad_data_analyze.py, run with python -m pytest tests
+"""
+import os
+import sys
+import numpy
+import xarray
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import persad_data_analyze as pdata
+
+def makeModels(count:int=4, seed:int=0) -> tuple:
+    # Projection and historical models on a small grid, with a zero and low historical values, and a NaN cell in one model
+    rng = numpy.random.default_rng(seed)
+    coords = {'lat':numpy.arange(5.0), 'lon':numpy.arange(6.0)}
+    models = []
+    hist_models = []
+    for index in range(count):
+        values = rng.normal(size=(5, 6)) * 10
+        hist = rng.uniform(0, 5, size=(5, 6))
+        hist[0, index] = 0
+        if index == 1:
+            values[2, 2] = numpy.nan
+        models.append(xarray.DataArray(values, dims=('lat', 'lon'), coords=coords))
+        hist_models.append(xarray.DataArray(hist, dims=('lat', 'lon'), coords=coords))
+    return (models, hist_models)
+
+@pytest.mark.parametrize("min_historical", [None, 1])
+def test_ensemble_matches_separate_passes(min_historical):
+    models, hist_models = makeModels()
+    # Historical values at or below min_historical are missing, as the pipeline does for SWE
+    masked_hist = hist_models if min_historical is None else [hist.where(hist > min_historical) for hist in hist_models]
+    expected_mean = pdata.getMeanModel(pdata.getRelativeRatioModels(models, masked_hist))
+    expected_agreement = pdata.getModelsAgreement(pdata.getMeanModel(models), models)
+
+    ensemble = pdata.getRelativeRatioEnsemble(models, hist_models, min_historical=min_historical)
+    numpy.testing.assert_array_equal(numpy.isnan(ensemble['mean'].values), numpy.isnan(expected_mean.values))
+    numpy.testing.assert_allclose(ensemble['mean'].values, expected_mean.values, rtol=1e-12, equal_nan=True)
+    numpy.testing.assert_array_equal(ensemble['agreement'].values, expected_agreement.values)
+    assert ensemble.attrs['model_count'] == len(models)
+
+    # Single precision running sums only change the result by rounding
+    single = pdata.getRelativeRatioEnsemble(models, hist_models, dtype=numpy.float32, min_historical=min_historical)
+    assert single['mean'].dtype == numpy.float32
+    numpy.testing.assert_allclose(single['mean'].values, expected_mean.values, rtol=1e-4, atol=1e-3, equal_nan=True)
+    numpy.testing.assert_array_equal(single['agreement'].values, expected_agreement.values)
+
+def writeModels(path:str, models:list, names:list) -> str:
+    xarray.Dataset({name:model for name, model in zip(names, models)}).to_netcdf(path)
+    return path
+
+def test_models_are_paired_by_name(tmp_path):
+    models, hist_models = makeModels(3)
+    names = ["ACCESS1-0", "CCSM4", "MIROC5"]
+    projection = writeModels(str(tmp_path / "et_RCP85.nc"), models, [name + "_rcp85" for name in names])
+    # The historical file lists the same models in a different order
+    historical = writeModels(str(tmp_path / "et_RCP85_now.nc"), hist_models[::-1], [name + "_now" for name in names[::-1]])
+    ensemble = pdata.getRelativeRatioEnsemble(pdata.iterModelsFromNetCDF(projection, names, unique=True),
+                                              pdata.iterModelsFromNetCDF(historical, names, unique=True))
+    expected = pdata.getMeanModel(pdata.getRelativeRatioModels(models, hist_models))
+    numpy.testing.assert_allclose(ensemble['mean'].values, expected.values, rtol=1e-12, equal_nan=True)
+
+def test_missing_model_raises(tmp_path):
+    models, hist_models = makeModels(3)
+    names = ["ACCESS1-0", "CCSM4", "MIROC5"]
+    projection = writeModels(str(tmp_path / "et_RCP85.nc"), models, names)
+    historical = writeModels(str(tmp_path / "et_RCP85_now.nc"), hist_models[:2], names[:2])
+    # Selected by name, the missing model is reported instead of shifting the pairs
+    with pytest.raises(KeyError):
+        list(pdata.iterModelsFromNetCDF(historical, names, unique=True))
+    # Selected by substring, the shorter list of models is an error rather than being cut short
+    with pytest.raises(ValueError):
+        pdata.getRelativeRatioEnsemble(pdata.iterModelsFromNetCDF(projection, names), pdata.iterModelsFromNetCDF(historical, names))
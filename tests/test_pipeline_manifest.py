@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for deciding which pipeline outputs are rebuilt (pipeline_manifest.py and generate_region_data.findStaleOutputs),
+run with python -m pytest tests
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generate_region_data as gdata
+import pipeline_manifest as pmanifest
+
+def writeFile(path:str, data:bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    # One metric, RCP and region set, the NetCDF files and shapefile are stand-ins since only their contents are hashed
+    for name in ["data", "shapefiles", "output"]:
+        os.makedirs(tmp_path / name)
+    monkeypatch.setattr(gdata, "data_dir", str(tmp_path / "data") + "/")
+    monkeypatch.setattr(gdata, "shapefile_dir", str(tmp_path / "shapefiles") + "/")
+    monkeypatch.setattr(gdata, "output_dir", str(tmp_path / "output") + "/")
+    monkeypatch.setattr(gdata, "metrics", ["et"])
+    monkeypatch.setattr(gdata, "rcps", ["_RCP85"])
+    monkeypatch.setattr(gdata, "shapefiles", ["regions"])
+    monkeypatch.setattr(gdata, "var_name", ["NAME"])
+    writeFile(gdata.data_dir + "et_RCP85.nc", b"projection")
+    writeFile(gdata.data_dir + "et_RCP85" + gdata.hist_suffix + ".nc", b"historical")
+    for extension in [".shp", ".dbf", ".shx"]:
+        writeFile(gdata.shapefile_dir + "regions" + extension, b"regions" + extension.encode())
+    return tmp_path
+
+def buildOutputs(statistics:list=[]) -> dict:
+    # What a successful run leaves behind: every output file and a manifest entry recording its inputs
+    manifest = pmanifest.loadManifest(gdata.output_dir + gdata.manifest_name)
+    stale, inputs = gdata.findStaleOutputs(manifest, statistics=statistics)
+    for (metric, rcp, shapefile) in stale:
+        for path in gdata.getOutputPaths(metric, rcp, shapefile):
+            writeFile(path, b"output")
+        manifest['outputs'][metric + rcp + shapefile] = {'inputs':inputs[(metric, rcp, shapefile)], 'code_version':gdata.getCodeVersion(),
+                                                         'outputs':gdata.getOutputPaths(metric, rcp, shapefile), 'statistics':list(statistics)}
+    pmanifest.saveManifest(gdata.output_dir + gdata.manifest_name, manifest)
+    return manifest
+
+def findStale(statistics:list=[]) -> dict:
+    return gdata.findStaleOutputs(pmanifest.loadManifest(gdata.output_dir + gdata.manifest_name), statistics=statistics)[0]
+
+def test_first_run_builds_everything(pipeline):
+    assert findStale() == {("et", "_RCP85", "regions"):"not in manifest"}
+
+def test_unchanged_inputs_are_not_rebuilt(pipeline):
+    buildOutputs()
+    assert findStale() == {}
+
+def test_touched_input_with_same_contents_is_not_rebuilt(pipeline):
+    buildOutputs()
+    path = gdata.data_dir + "et_RCP85.nc"
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime + 100, stat.st_mtime + 100))
+    manifest = pmanifest.loadManifest(gdata.output_dir + gdata.manifest_name)
+    stale, inputs = gdata.findStaleOutputs(manifest)
+    assert stale == {}
+    # The new modification time is kept, so the file isn't hashed again next run
+    assert manifest['outputs']["et_RCP85regions"]['inputs'][path]['mtime'] == os.stat(path).st_mtime
+
+@pytest.mark.parametrize("path", ["et_RCP85.nc", "et_RCP85_now.nc", "regions.dbf"])
+def test_changed_input_is_rebuilt(pipeline, path):
+    buildOutputs()
+    path = (gdata.shapefile_dir if path.startswith("regions") else gdata.data_dir) + path
+    writeFile(path, b"changed")
+    assert list(findStale().values())[0].startswith("input changed")
+
+def test_missing_output_is_rebuilt(pipeline):
+    buildOutputs()
+    os.remove(gdata.getOutputPaths("et", "_RCP85", "regions")[0])
+    assert list(findStale().values())[0].startswith("missing output")
+
+def test_changed_statistics_are_rebuilt(pipeline):
+    buildOutputs(statistics=["std"])
+    assert findStale(statistics=["std"]) == {}
+    assert findStale(statistics=["std", "p90"]) == {("et", "_RCP85", "regions"):"statistics changed"}
+    assert findStale(statistics=[]) == {("et", "_RCP85", "regions"):"statistics changed"}
+
+def test_changed_code_is_rebuilt(pipeline, monkeypatch):
+    buildOutputs()
+    monkeypatch.setattr(gdata, "getCodeVersion", lambda: "changed")
+    assert findStale() == {("et", "_RCP85", "regions"):"code changed"}
+
+@pytest.mark.parametrize("built", [False, True])
+def test_dry_run_writes_nothing(pipeline, built, capsys):
+    if built:
+        buildOutputs()
+        writeFile(gdata.data_dir + "et_RCP85.nc", b"changed")
+    before = {path:os.stat(os.path.join(gdata.output_dir, path)).st_mtime_ns for path in os.listdir(gdata.output_dir)}
+    assert gdata.main(["--dry-run"]) == 0
+    after = {path:os.stat(os.path.join(gdata.output_dir, path)).st_mtime_ns for path in os.listdir(gdata.output_dir)}
+    assert before == after
+    assert "1 of 1 outputs would be rebuilt" in capsys.readouterr().out
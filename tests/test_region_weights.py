@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the region weights and statistics in region_weights.py, run with python -m pytest tests
+"""
+import os
+import sys
+import numpy
+import pytest
+import shapely
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import region_weights as rweights
+
+def makeWeights(rows:list, cells:int) -> sparse.csr_matrix:
+    # Each row is a {cell: weight} dict, empty rows are regions without any cells
+    data = [weight for row in rows for weight in row.values()]
+    indices = [cell for row in rows for cell in row.keys()]
+    indptr = numpy.cumsum([0] + [len(row) for row in rows])
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), cells))
+
+@pytest.mark.parametrize("empty_row", [0, 1, 2])
+def test_statistics_with_empty_regions(empty_row):
+    # A region outside the grid has no cells, wherever it is listed (the last row used to raise IndexError)
+    rows = [{0:0.25, 1:0.75}, {2:0.5, 3:0.5}]
+    rows.insert(empty_row, {})
+    weights = makeWeights(rows, 4)
+    data = numpy.array([[1.0, 3.0], [5.0, 7.0]])
+    statistics = rweights.applyWeightStatistics(weights, data, ["mean", "std", "min", "max", "p50", "iqr", "ge5"])
+    full = [row for row in range(3) if row != empty_row]
+    for name in ["std", "min", "max", "p50", "iqr", "ge5"]:
+        assert numpy.isnan(statistics[name][empty_row])
+    assert statistics["mean"][empty_row] == 0
+    numpy.testing.assert_allclose(statistics["p50"][full], [3.0, 5.0])
+    numpy.testing.assert_allclose(statistics["min"][full], [1.0, 5.0])
+    numpy.testing.assert_allclose(statistics["max"][full], [3.0, 7.0])
+    numpy.testing.assert_allclose(statistics["iqr"][full], [2.0, 2.0])
+    numpy.testing.assert_allclose(statistics["ge5"][full], [0.0, 1.0])
+
+def test_statistics_without_any_cells():
+    weights = makeWeights([{}, {}], 4)
+    statistics = rweights.applyWeightStatistics(weights, numpy.ones((2, 2)), ["p25", "min", "std"])
+    assert all(numpy.isnan(values).all() for values in statistics.values())
+
+
+@pytest.mark.parametrize("area_mode", ["degrees", "equal_area"])
+def test_raster_weights_with_null_geometry(area_mode):
+    # Shapefile records without geometry are read as None, they get no cells instead of failing the whole region set
+    geometries = numpy.array([shapely.box(0, 0, 1, 1), None, shapely.box(0.5, 0.5, 2, 2)], dtype=object)
+    lat = numpy.arange(-0.25, 3, 0.5)
+    lon = numpy.arange(-0.25, 3, 0.5)
+    weights, valid, error_bound = rweights.calculateRasterWeights(geometries, lat, lon, supersample=4, area_mode=area_mode)
+    numpy.testing.assert_allclose(numpy.asarray(weights.sum(axis=1)).ravel(), [1.0, 0.0, 1.0])
+    numpy.testing.assert_array_equal(valid, [True, False, True])
+    assert error_bound[1] == 0
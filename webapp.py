@@ -0,0 +1,423 @@
+"""
+Created on Sun Feb 28 18:28:41 2021
+Updated 3/4/21
+
+@author: Cameron Cummins
+"""
+
+from flask import Flask, render_template, request, abort, jsonify, Response
+from werkzeug.security import safe_join
+from werkzeug.datastructures import ETags
+from werkzeug.http import quote_etag
+from os.path import join, isfile, getmtime
+from os import listdir, stat
+from collections import OrderedDict
+import threading
+import mimetypes
+import sqlite3
+import hashlib
+import gzip
+import time
+import redis
+import json
+import math
+import os
+import region_results as rresults
+import data_backends as dbackends
+
+# Set flask app name and upload folder. This tells flask where the top directory is.
+app = Flask(__name__)
+# In this case, we want the top directory to be the upload directory (this will also function as download)
+app.config['UPLOAD_FOLDER'] = "."
+# Start from the top directory, where is the data located
+data_dir = app.root_path + "/data/json_data/"
+# Connect to redis database server, decoding the responses converts all data recieved from bytes into python objects
+rd = redis.StrictRedis(host = "127.0.0.1", port = 6379, decode_responses = True)
+# build_redis.py loads each dataset under a new prefix and then points this key at it
+alias_key = "dataset:current"
+# build_redis.py publishes the new prefix on this channel after every reload
+reload_channel = "dataset:reload"
+# build_redis.py also stores every value of a region in one hash, "<prefix>:region:<region set>:<region name>"
+region_key_format = "{}:region:{}:{}"
+# Where the data is served from: "redis" (loaded by build_redis.py) or "results" (the region results files, no redis needed)
+app.config['DATA_BACKEND'] = os.environ.get("WEBAPP_DATA_BACKEND", "redis")
+# Number of datasets kept in memory by each web process (read from the environment, the cache is created when this module is imported)
+app.config['DATA_CACHE_SIZE'] = int(os.environ.get("WEBAPP_DATA_CACHE_SIZE", 256))
+# Longest time (seconds) the cache goes without checking the dataset version, in case a reload message is missed
+app.config['DATA_VERSION_CHECK_INTERVAL'] = float(os.environ.get("WEBAPP_DATA_VERSION_CHECK_INTERVAL", 5))
+
+class DataCache:
+    """
+    Process-local LRU cache of Redis values. The data is read-only between loads, so every entry is valid
+    until the dataset version (the alias key) changes, at which point the whole cache is cleared.
+    """
+    def __init__(self, max_size:int, check_interval:float):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def setVersion(self, version:str) -> None:
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            self.checked = time.monotonic()
+    
+    def isVersionExpired(self) -> bool:
+        # Only ask Redis for the current version every check_interval seconds (reload messages update it immediately)
+        return time.monotonic() - self.checked > self.check_interval
+    
+    def getVersion(self) -> str:
+        if self.isVersionExpired():
+            self.setVersion(data_backend.getVersion())
+        return self.version
+    
+    def lookup(self, key:str):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        return None
+    
+    def store(self, key:str, version:str, value) -> None:
+        # Missing keys aren't cached so they show up as soon as they are loaded
+        if value is None:
+            return
+        with self.lock:
+            # Drop values read from a dataset that was replaced while they were being loaded
+            if version != self.version:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    
+    def get(self, key:str, version:str, load):
+        value = self.lookup(key)
+        if value is None:
+            value = load(key)
+            self.store(key, version, value)
+        return value
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits':self.hits, 'misses':self.misses, 'size':len(self.entries), 'max_size':self.max_size, 'version':self.version}
+
+# Responses requested with ?v=<etag> can never change, so browsers may keep them for a year
+immutable_cache_control = "public, max-age=31536000, immutable"
+# Files that are already compressed aren't worth gzipping again
+precompressed_extensions = (".zip", ".gz", ".png", ".jpg", ".pdf", ".pptx", ".sbn", ".sbx")
+
+def buildPayload(data:bytes, compress:bool=True, compressed:bytes=None) -> dict:
+    # Everything needed to answer a request is derived once, when the data is loaded, instead of on every request
+    if compress and compressed is None:
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    return {'data':data, 'etag':hashlib.sha256(data).hexdigest()[:32], 'gzip':compressed if compress else None}
+
+def makeCachedResponse(payload:dict, mimetype:str) -> Response:
+    status, headers, body = getCachedResponseParts(payload, mimetype, request.if_none_match, request.accept_encodings['gzip'] > 0, request.args.get('v'))
+    return Response(body, status=status, headers=headers)
+
+def getCachedResponseParts(payload:dict, mimetype:str, if_none_match:ETags, accepts_gzip:bool, version_arg:str) -> tuple:
+    """
+    Parameters
+    ----------
+    payload : dict
+        payload from buildPayload
+    mimetype : str
+        content type of the data
+    if_none_match : werkzeug.datastructures.ETags
+        ETags the client already has
+    accepts_gzip : bool
+        whether the client accepts gzip encoding
+    version_arg : str
+        value of the ?v= argument, or None
+
+    Returns
+    -------
+    tuple
+        (status, headers, body) of the response, shared by the Flask routes and the ASGI app
+    """
+    headers = {'ETag':quote_etag(payload['etag']), 'Vary':'Accept-Encoding'}
+    # URLs carrying the content hash are immutable, anything else has to be revalidated (cheaply, with the ETag)
+    headers['Cache-Control'] = immutable_cache_control if version_arg == payload['etag'] else "no-cache"
+    # The browser already has this exact content
+    if if_none_match.contains(payload['etag']):
+        return (304, headers, b'')
+    headers['Content-Type'] = mimetype
+    if payload['gzip'] is not None and accepts_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return (200, headers, payload['gzip'])
+    return (200, headers, payload['data'])
+
+# Path -> (modification time, size, payload) of every file served so far
+file_payloads = {}
+file_payloads_lock = threading.Lock()
+
+def getFilePayload(path:str) -> dict:
+    # Files are only read, hashed and compressed again if they change on disk
+    file_stat = stat(path)
+    with file_payloads_lock:
+        cached = file_payloads.get(path)
+    if cached is not None and cached[0] == file_stat.st_mtime_ns and cached[1] == file_stat.st_size:
+        return cached[2]
+    with open(path, 'rb') as f:
+        data = f.read()
+    # Use a gzip file generated ahead of time next to the original if there is an up to date one
+    compressed = None
+    if isfile(path + ".gz") and getmtime(path + ".gz") >= getmtime(path):
+        with open(path + ".gz", 'rb') as f:
+            compressed = f.read()
+    payload = buildPayload(data, compress=not path.lower().endswith(precompressed_extensions), compressed=compressed)
+    with file_payloads_lock:
+        file_payloads[path] = (file_stat.st_mtime_ns, file_stat.st_size, payload)
+    return payload
+
+data_cache = DataCache(app.config['DATA_CACHE_SIZE'], app.config['DATA_VERSION_CHECK_INTERVAL'])
+
+def listenForReloads() -> None:
+    # Clear the cache as soon as build_redis.py announces a new dataset, instead of waiting for the next version check
+    try:
+        pubsub = rd.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{reload_channel:lambda message: data_cache.setVersion(message['data'])})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+    except redis.exceptions.ConnectionError:
+        print("Could not subscribe to " + reload_channel + ", falling back to checking the dataset version every " + str(data_cache.check_interval) + " s")
+
+# Region sets served by the results backend and the region and point lookups
+region_sets = ["CA_Counties_TIGER2016", "CA_Places_TIGER2016", "CA_Bulletin_118_Groundwater_Basins", "WBD_USGS_HUC10_CA"]
+results_suffix = "_results.npz"
+
+if app.config['DATA_BACKEND'] == "results":
+    data_backend = dbackends.ResultsBackend(data_dir, region_sets, results_suffix)
+else:
+    data_backend = dbackends.RedisBackend(rd, alias_key, region_key_format)
+    listenForReloads()
+
+# For downloading entire files within the flask directories (such as JSON or Shapefile)
+@app.route('/download/<path:filename>', methods=['GET', 'POST'])
+def download(filename):
+    uploads = join(app.root_path, app.config['UPLOAD_FOLDER'])
+    path = safe_join(uploads, filename)
+    if path is None or not isfile(path):
+        abort(404)
+    return makeCachedResponse(getFilePayload(path), mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream")
+
+# Lets templates link to a file by its content hash, e.g. {{ asset_url('geojson/CA_Counties_TIGER2016.geojson') }}
+@app.context_processor
+def assetUrlProcessor():
+    def asset_url(filename):
+        path = safe_join(join(app.root_path, app.config['UPLOAD_FOLDER']), filename)
+        return "/download/" + filename + "?v=" + getFilePayload(path)['etag']
+    return {'asset_url':asset_url}
+
+# Simplified region geometry generated by generate_geometry_levels.py (same zoom levels as zoom_levels in that script)
+geometry_dir = app.root_path + "/geometry_levels/"
+geometry_zoom_levels = [5, 7, 9, 11]
+
+# Region geometry simplified for the map's zoom level, e.g. /geometry/CA_Counties_TIGER2016?zoom=6.5&format=topojson
+@app.route('/geometry/<region_set>')
+def getGeometry(region_set):
+    geometry_format = request.args.get('format', default="geojson")
+    if geometry_format not in ["geojson", "topojson"]:
+        abort(400)
+    # Levels are generated for 256 px tiles, Mapbox GL zoom levels use 512 px tiles so they are one level lower
+    zoom = request.args.get('zoom', default=geometry_zoom_levels[-1], type=float) + 1
+    # The coarsest level that is still detailed enough for this zoom, or the most detailed one there is
+    level = next((level for level in geometry_zoom_levels if level >= zoom), geometry_zoom_levels[-1])
+    path = safe_join(geometry_dir, region_set + "_z" + str(level) + "." + geometry_format)
+    if path is None or not isfile(path):
+        abort(404)
+    return makeCachedResponse(getFilePayload(path), mimetype="application/json")
+
+# Vector tile pyramid of the region layers built by generate_tiles.py
+tiles_path = app.root_path + "/region_tiles.mbtiles"
+tile_connections = threading.local()
+
+def getTileConnection() -> sqlite3.Connection:
+    # SQLite connections can't be shared between threads, so each request thread opens its own (read only)
+    if getattr(tile_connections, 'connection', None) is None:
+        tile_connections.connection = sqlite3.connect("file:" + tiles_path + "?mode=ro", uri=True)
+    return tile_connections.connection
+
+# A single vector tile of a region layer, e.g. /tiles/CA_Counties_TIGER2016/6/10/24.mvt
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.mvt')
+def getTile(layer, z, x, y):
+    if not isfile(tiles_path):
+        abort(404)
+    # Tiles are stored with rows counted from the bottom (TMS), the map counts them from the top
+    row = getTileConnection().execute("SELECT tile_data, tile_etag FROM tiles WHERE layer = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                      (layer, z, x, (1 << z) - 1 - y)).fetchone()
+    # No regions in this tile
+    if row is None:
+        return Response(status=204)
+    compressed, etag = row
+    # Tiles are stored gzipped, so they are served as they are to any browser that accepts gzip and only decompressed for the others
+    data = None if request.accept_encodings['gzip'] > 0 else gzip.decompress(compressed)
+    return makeCachedResponse({'data':data, 'etag':etag, 'gzip':compressed}, mimetype="application/vnd.mapbox-vector-tile")
+
+# Region results (region_results.npz written by generate_region_data.py) and shapefiles for the region and point lookups
+shapefile_dir = app.root_path + "/shapefiles/"
+# Results files version -> results tables, spatial indexes and RCP comparison payloads of every region set, built for that version
+region_tables = {}
+region_tables_lock = threading.Lock()
+# Region set -> (shapefile modification time, spatial index), the regions only move when the shapefile changes
+region_trees = {}
+
+def getRegionTables() -> dict:
+    # The tables come from the results files, so they are rebuilt whenever those files change. With the results backend that is
+    # the data version, with Redis it is independent of the alias (the pipeline rewrites the files before build_redis.py runs)
+    if isinstance(data_backend, dbackends.ResultsBackend):
+        version = data_cache.getVersion()
+    else:
+        version = dbackends.getResultsVersion([data_dir + region_set + results_suffix for region_set in region_sets])
+    tables = region_tables.get(version)
+    if tables is None:
+        with region_tables_lock:
+            tables = region_tables.get(version)
+            if tables is None:
+                tables = loadRegionTables(version)
+                # Requests still using the previous tables keep their own reference to them
+                region_tables.clear()
+                region_tables[version] = tables
+    return tables
+
+def loadRegionTables(version:str) -> dict:
+    tables = {'results':{}, 'trees':{}, 'comparisons':{}}
+    for region_set in region_sets:
+        # The results backend already holds the tables of this version, otherwise they are read from the results files
+        results = data_backend.getResults(version, region_set) if isinstance(data_backend, dbackends.ResultsBackend) else None
+        if results is None and isfile(data_dir + region_set + results_suffix):
+            results = rresults.loadRegionResults(data_dir + region_set + results_suffix)
+        if results is None:
+            continue
+        tables['results'][region_set] = results
+        tables['comparisons'][region_set] = buildComparisonPayloads(results, rresults.calculateComparisons(results))
+        tree = getRegionTree(region_set)
+        if tree is not None:
+            tables['trees'][region_set] = tree
+    return tables
+
+def getRegionTree(region_set:str):
+    path = shapefile_dir + region_set + ".shp"
+    if not isfile(path):
+        return None
+    modified = stat(path).st_mtime_ns
+    if region_set not in region_trees or region_trees[region_set][0] != modified:
+        region_trees[region_set] = (modified, rresults.buildRegionTree(path))
+    return region_trees[region_set][1]
+
+def buildComparisonPayloads(results:dict, comparisons:list) -> dict:
+    """
+    Parameters
+    ----------
+    results : dict
+        region results of one region set
+    comparisons : list of dict
+        comparisons from region_results.calculateComparisons
+
+    Returns
+    -------
+    dict
+        (metric, product) -> payload of the matching comparisons, with None matching every metric or product
+    """
+    metrics = sorted(set(comparison['metric'] for comparison in comparisons))
+    products = sorted(set(comparison['product'] for comparison in comparisons))
+    payloads = {}
+    for metric in metrics + [None]:
+        for product in products + [None]:
+            selected = [comparison for comparison in comparisons if metric in (None, comparison['metric']) and product in (None, comparison['product'])]
+            # Region values are listed in row order, alongside the region names
+            data = {'index':results['index'].tolist(), 'NAME':results['NAME'].tolist(), 'comparisons':[
+                    {name:value if isinstance(value, str) else [None if math.isnan(item) else item for item in value.tolist()] for name, value in comparison.items()}
+                    for comparison in selected]}
+            payloads[(metric, product)] = buildPayload(json.dumps(data, allow_nan=False).encode('utf-8'))
+    return payloads
+
+# RCP85 - RCP45 differences, ranks and percentiles across the regions of a set, e.g. /compare/CA_Counties_TIGER2016?metric=et&product=totalaverage
+@app.route('/compare/<region_set>')
+def getComparison(region_set):
+    payload = getRegionTables()['comparisons'].get(region_set, {}).get((request.args.get('metric'), request.args.get('product')))
+    if payload is None:
+        abort(404)
+    return makeCachedResponse(payload, mimetype="application/json")
+
+# Every metric and RCP for a single region, e.g. /region/CA_Counties_TIGER2016/Sierra
+@app.route('/region/<region_set>/<name>')
+def getRegion(region_set, name):
+    results = getRegionTables()['results'].get(region_set)
+    if results is None or name not in results['rows']:
+        abort(404)
+    region = rresults.getRegionValues(results, results['rows'][name])
+    region['region_set'] = region_set
+    return jsonify(region)
+
+# Every metric and RCP for the regions containing a point, e.g. /point?lat=38.5&lon=-121.5 (optionally &set=<region set>)
+@app.route('/point')
+def getPoint():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None:
+        abort(400)
+    tables = getRegionTables()
+    requested_sets = [request.args['set']] if 'set' in request.args else list(tables['trees'].keys())
+    regions = []
+    for region_set in requested_sets:
+        if region_set not in tables['trees']:
+            abort(404)
+        for row in rresults.findRegionRows(tables['trees'][region_set], lat, lon):
+            region = rresults.getRegionValues(tables['results'][region_set], row)
+            region['region_set'] = region_set
+            regions.append(region)
+    return jsonify(regions)
+
+# A basic data request that grabs key-values from the data backend using the filters specified by paramters
+@app.route('/data/<key>')
+def getData(key):
+    # Read from the current version of the data
+    version = data_cache.getVersion()
+    payload = data_cache.get(key, version, lambda key: loadDataPayload(version, key))
+    if payload is None:
+        abort(404)
+    return makeCachedResponse(payload, mimetype="application/json")
+
+def loadDataPayload(version:str, key:str) -> dict:
+    data = data_backend.getDataset(version, key)
+    return None if data is None else buildPayload(data.encode('utf-8'))
+
+# Selected values of a single region, e.g. /data/CA_Counties_TIGER2016/Sierra?fields=et_RCP85_totalaverage,et_RCP45_totalaverage
+# Only the requested fields are read (every field if none are given)
+@app.route('/data/<region_set>/<region>')
+def getRegionData(region_set, region):
+    version = data_cache.getVersion()
+    fields = [field for field in request.args.get('fields', "").split(",") if field != ""]
+    key = "region:" + region_set + ":" + region + "?" + ",".join(fields)
+    payload = data_cache.get(key, version, lambda key: buildRegionPayload(data_backend.getRegion(version, region_set, region, fields)))
+    if payload is None:
+        abort(404)
+    return makeCachedResponse(payload, mimetype="application/json")
+
+def buildRegionPayload(region:dict) -> dict:
+    return None if region is None else buildPayload(json.dumps(region, allow_nan=False).encode('utf-8'))
+
+# Hit/miss counters for the in-process data cache
+@app.route('/cache/stats')
+def getCacheStats():
+    return jsonify(data_cache.stats())
+
+# This is the main landing page, what the user sees
+@app.route('/')
+def main():
+    # We use the HTML file as the template
+    return render_template("mapbox_map.html")
+
+if __name__ == "__main__":
+    # Port 1024 is open on thunder for most users
+    app.run(host="localhost", port=1024, debug=True)
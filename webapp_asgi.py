@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Production (ASGI) serving mode for the web app.
+
+The /data routes, which are answered from Redis, are served natively with an async Redis client
+sharing a bounded connection pool, so concurrent map users don't wait behind one blocking request.
+Every other route is passed through to the Flask app, running in a thread pool.
+
+Run with, for example:
+    python webapp_asgi.py --workers 4 --port 1024
+"""
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_etags, parse_accept_header
+from urllib.parse import parse_qs
+import redis.asyncio
+import argparse
+import uvicorn
+import data_backends as dbackends
+import webapp
+import os
+
+redis_host = "127.0.0.1"
+redis_port = 6379
+# Most Redis connections each worker process will open, requests wait for a free connection beyond that
+# (read from the environment so every worker process started by uvicorn gets the command line setting)
+max_connections = int(os.environ.get("WEBAPP_MAX_CONNECTIONS", 32))
+# Longest time (seconds) a request waits for a free connection before failing
+connection_timeout = 5
+
+json_headers = [(b'content-type', b'application/json')]
+
+class AsyncDataApp:
+    """
+    ASGI app serving /data/<key> and /data/<region set>/<region> from Redis with an async client, and passing
+    every other request through to a WSGI app. The Redis pool is opened on startup and closed on shutdown.
+    """
+    def __init__(self, wsgi_app, max_connections:int, connection_timeout:float):
+        self.wsgi_app = WsgiToAsgi(wsgi_app)
+        self.max_connections = max_connections
+        self.connection_timeout = connection_timeout
+        self.rd = None
+
+    async def __call__(self, scope:dict, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        parts = scope['path'].split("/")
+        # /data/<key> and /data/<region set>/<region>, other backends are in memory and answered just as fast by the Flask app
+        if isinstance(webapp.data_backend, dbackends.RedisBackend) and scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD') and len(parts) in (3, 4) and parts[1] == "data" and all(part != "" for part in parts[2:]):
+            await self.handleData(scope, send, parts[2:])
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # The pool blocks (up to the timeout) instead of opening more than max_connections connections
+                pool = redis.asyncio.BlockingConnectionPool(host=redis_host, port=redis_port, max_connections=self.max_connections,
+                                                            timeout=self.connection_timeout, decode_responses=True)
+                self.rd = redis.asyncio.StrictRedis(connection_pool=pool)
+                try:
+                    webapp.data_cache.setVersion(await self.rd.get(webapp.alias_key))
+                except redis.exceptions.ConnectionError:
+                    print("Could not connect to redis at startup, /data requests will fail until it is available")
+                await send({'type':'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Close every pooled connection once the server has finished the requests in flight
+                await self.rd.aclose(close_connection_pool=True)
+                await send({'type':'lifespan.shutdown.complete'})
+                return
+
+    async def handleData(self, scope:dict, send, parts:list) -> None:
+        try:
+            if webapp.data_cache.isVersionExpired():
+                webapp.data_cache.setVersion(await self.rd.get(webapp.alias_key))
+            version = webapp.data_cache.version
+            if len(parts) == 1:
+                payload = await self.getPayload(parts[0], version, lambda: self.loadDataPayload(parts[0] if version is None else version + ":" + parts[0]))
+            elif version is None:
+                payload = None
+            else:
+                fields = [field for field in getQueryArgument(scope, 'fields', "").split(",") if field != ""]
+                key = "region:" + parts[0] + ":" + parts[1] + "?" + ",".join(fields)
+                payload = await self.getPayload(key, version, lambda: self.loadRegionPayload(webapp.region_key_format.format(version, parts[0], parts[1]), fields))
+        except redis.exceptions.RedisError:
+            await sendResponse(send, scope, 503, json_headers, b'{"error": "data unavailable"}')
+            return
+        if payload is None:
+            await sendResponse(send, scope, 404, json_headers, b'{"error": "not found"}')
+            return
+        headers = {name.decode('latin-1').lower():value.decode('latin-1') for name, value in scope['headers']}
+        status, response_headers, body = webapp.getCachedResponseParts(payload, "application/json", parse_etags(headers.get('if-none-match')),
+                                                                       parse_accept_header(headers.get('accept-encoding'))['gzip'] > 0,
+                                                                       getQueryArgument(scope, 'v', None))
+        await sendResponse(send, scope, status, [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers.items()], body)
+
+    async def getPayload(self, key:str, version:str, load) -> dict:
+        # Same process-local cache as the Flask routes, loaded with an awaitable instead of a blocking call
+        payload = webapp.data_cache.lookup(key)
+        if payload is None:
+            payload = await load()
+            webapp.data_cache.store(key, version, payload)
+        return payload
+
+    async def loadDataPayload(self, redis_key:str) -> dict:
+        data = await self.rd.get(redis_key)
+        return None if data is None else webapp.buildPayload(data.encode('utf-8'))
+
+    async def loadRegionPayload(self, redis_key:str, fields:list) -> dict:
+        if len(fields) == 0:
+            return webapp.buildRegionPayload(dbackends.decodeRegionHash(await self.rd.hgetall(redis_key)))
+        return webapp.buildRegionPayload(dbackends.decodeRegionHash(dict(zip(["index", "valid"] + fields, await self.rd.hmget(redis_key, ["index", "valid"] + fields)))))
+
+def getQueryArgument(scope:dict, name:str, default:str) -> str:
+    values = parse_qs(scope['query_string'].decode('latin-1')).get(name)
+    return default if values is None else values[0]
+
+async def sendResponse(send, scope:dict, status:int, headers:list, body:bytes) -> None:
+    await send({'type':'http.response.start', 'status':status, 'headers':headers + [(b'content-length', str(len(body)).encode())]})
+    # HEAD requests get the headers of the GET response without the body
+    await send({'type':'http.response.body', 'body':b'' if scope['method'] == 'HEAD' else body})
+
+app = AsyncDataApp(webapp.app, max_connections, connection_timeout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the web app with uvicorn.")
+    parser.add_argument("--host", default="localhost")
+    # Port 1024 is open on thunder for most users
+    parser.add_argument("--port", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes, each with its own redis connection pool and data cache")
+    parser.add_argument("--max-connections", type=int, default=max_connections, help="redis connections per worker process")
+    parser.add_argument("--cache-size", type=int, default=webapp.app.config['DATA_CACHE_SIZE'], help="datasets kept in memory by each worker process")
+    args = parser.parse_args()
+    os.environ["WEBAPP_MAX_CONNECTIONS"] = str(args.max_connections)
+    os.environ["WEBAPP_DATA_CACHE_SIZE"] = str(args.cache_size)
+    # uvicorn needs an import string to start more than one worker, each worker imports this module again
+    uvicorn.run("webapp_asgi:app", host=args.host, port=args.port, workers=args.workers, timeout_graceful_shutdown=30)